@@ -0,0 +1,66 @@
+import time
+import logging
+from pathlib import Path
+
+import typer
+
+from processors.postgres.deletion import table_map
+from processors.postgres.indices import create_indices
+from processors.postgres.load import load_scripts
+from shared.config import settings
+
+
+def load_postgres(tmp_dir: Path,  # Directory with the flattened partitions and SQL scripts (see update_postgres.py)
+                  skip_deletion: bool = False,
+                  connections: int = 4,  # Number of scripts loaded (or tables indexed) at the same time
+                  synchronous_commit: bool = False,  # Off is fine for bulk loads, we can always re-run them
+                  maintenance_work_mem: str = '1GB',  # Per connection, also used for building indexes
+                  work_mem: str = '256MB',  # Used for joins with the ids to delete and staged rows
+                  indices: bool = True,  # Rebuild indexes (see setup/pg_indices.sql) and ANALYZE loaded tables
+                  parallel_workers: int = 2,  # max_parallel_maintenance_workers per index build
+                  streamed: bool = False,  # Rows were streamed (update_postgres.py --stream), only do the indexes
+                  loglevel: str = 'INFO'):
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s (%(threadName)s): %(message)s', level=loglevel)
+
+    session_settings = {
+        'synchronous_commit': 'on' if synchronous_commit else 'off',
+        'maintenance_work_mem': maintenance_work_mem,
+        'work_mem': work_mem,
+    }
+
+    # Phases run one after another, so nothing gets deleted after it was copied
+    phases = [] if streamed else [('Copying new or updated objects', '*-cpy.sql')]
+    if not skip_deletion and not streamed:
+        phases = [('Deleting merged objects', '*-merged_del.sql'),
+                  ('Deleting existing new objects', '*-del.sql')] + phases
+
+    loaded = set()
+    failed = []
+    for description, pattern in phases:
+        scripts = sorted(tmp_dir.glob(pattern))
+        logging.info(f'{description} ({len(scripts):,} scripts)')
+        start = time.time()
+        written, phase_failed = load_scripts(scripts, n_connections=connections, session_settings=session_settings)
+        loaded |= written
+        failed += phase_failed
+        logging.info(f'{description} took {time.time() - start:.1f}s')
+
+    if indices:
+        if streamed:
+            # We don't know what was streamed, so all tables get new statistics
+            loaded = {f'{settings.pg_schema}.{table}' for tables in table_map.values() for table, _ in tables}
+        logging.info(f'Creating indexes and analyzing {len(loaded):,} tables')
+        start = time.time()
+        failed += create_indices(analyze=loaded, n_connections=connections,
+                                 session_settings={**session_settings,
+                                                   'max_parallel_maintenance_workers': str(parallel_workers)})
+        logging.info(f'Creating indexes took {time.time() - start:.1f}s')
+
+    if len(failed) > 0:
+        logging.error(f'{len(failed):,} scripts or tables failed: {", ".join(str(item) for item in failed)}')
+        raise typer.Exit(code=1)
+    logging.info('Postgres is updated.')
+
+
+if __name__ == "__main__":
+    typer.run(load_postgres)
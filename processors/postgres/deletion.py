@@ -1,6 +1,9 @@
 from pathlib import Path
+from typing import Generator, Iterable
 
-from shared.util import get_ids_to_delete, batched, ObjectType
+import psycopg
+
+from shared.util import get_ids_to_delete, ObjectType
 from shared.config import settings
 
 table_map: dict[ObjectType, list[tuple[str, str]]] = {
@@ -12,8 +15,8 @@ table_map: dict[ObjectType, list[tuple[str, str]]] = {
     ],
     'institution': [
         ('institutions', 'id'),
-        ('institutions_association', 'institution_a_id'),
-        ('institutions_concept', 'institution_id')
+        ('institutions_associations', 'institution_a_id'),
+        ('institutions_concepts', 'institution_id')
     ],
     'publisher': [
         ('publishers', 'id')
@@ -23,7 +26,7 @@ table_map: dict[ObjectType, list[tuple[str, str]]] = {
     ],
     'concept': [
         ('concepts', 'id'),
-        ('concepts_ancestor', 'concept_a_id'),
+        ('concepts_ancestors', 'concept_a_id'),
         ('concepts_related', 'concept_a_id')
     ],
     'funder': [
@@ -32,34 +35,65 @@ table_map: dict[ObjectType, list[tuple[str, str]]] = {
     'work': [
         ('works', 'id'),
         ('works_authorships', 'work_id'),
+        ('works_authorship_institutions', 'work_id'),
         ('works_concepts', 'work_id'),
         ('works_locations', 'work_id'),
         ('works_references', 'work_a_id'),  # we are not explicitly deleting the other direction (`work_b_id`)
-        ('works_related', 'work_a_id')
+        ('works_related', 'work_a_id'),
+        ('works_sdgs', 'work_id')
     ]
 }
 
 
+TEMP_TABLE = 'ids_to_delete'
+
+
 def filter_none(lst):
     return [l for l in lst if l is not None]
 
 
-def generate_deletions(ids: list[str],
-                       object_type: ObjectType,
-                       batch_size: int = 1000):
-    for del_batch in batched(ids, batch_size):
-        id_lst = "','".join(filter_none(del_batch))
-        for table, key in table_map[object_type]:
-            yield f"DELETE FROM {settings.pg_schema}.{table} t WHERE t.{key} IN ('{id_lst}');"
+def delete_statements(object_type: ObjectType) -> list[str]:
+    # One join per table with the ids in `TEMP_TABLE` (instead of planning one `IN (...)` list per batch and table)
+    return [f'DELETE FROM {settings.pg_schema}.{table} t USING {TEMP_TABLE} d WHERE t.{key} = d.id;'
+            for table, key in table_map[object_type]]
+
+
+def generate_deletions(ids: Iterable[str], object_type: ObjectType) -> Generator[str, None, None]:
+    # Lines of a psql script that copies the ids into a temporary table and deletes all their rows.
+    # The ids are part of the script (like in dumps of `pg_dump`), terminated by "\."
+    yield 'BEGIN;'
+    yield f'CREATE TEMPORARY TABLE {TEMP_TABLE} (id text) ON COMMIT DROP;'
+    yield f'COPY {TEMP_TABLE} (id) FROM STDIN;'
+    yield from filter_none(ids)
+    yield '\\.'
+    yield f'ANALYZE {TEMP_TABLE};'
+    yield from delete_statements(object_type)
+    yield 'COMMIT;'
+
+
+def execute_deletions(cur: psycopg.Cursor, ids: Iterable[str], object_type: ObjectType):
+    # Same as `generate_deletions`, but runs the statements right away within the transaction of `cur`
+    cur.execute(f'CREATE TEMPORARY TABLE {TEMP_TABLE} (id text) ON COMMIT DROP;')
+    with cur.copy(f'COPY {TEMP_TABLE} (id) FROM STDIN') as copy:
+        for oid in filter_none(ids):
+            copy.write_row((oid,))
+    cur.execute(f'ANALYZE {TEMP_TABLE};')
+    for statement in delete_statements(object_type):
+        cur.execute(statement)
 
 
 def generate_deletions_from_merge_file(merge_files: list[Path],
                                        out_file: Path,
-                                       object_type: ObjectType,
-                                       batch_size: int = 1000):
+                                       object_type: ObjectType):
     out_file.parent.mkdir(exist_ok=True, parents=True)
     with open(out_file, 'w') as f:
-        for del_batch in batched(get_ids_to_delete(merge_files), batch_size):
-            id_lst = "','".join(filter_none(del_batch))
-            for table, key in table_map[object_type]:
-                f.write(f"DELETE FROM {settings.pg_schema}.{table} t WHERE t.{key} IN ('{id_lst}');\n")
+        for line in generate_deletions(get_ids_to_delete(merge_files), object_type=object_type):
+            f.write(line + '\n')
+
+
+def execute_deletions_from_merge_file(merge_files: list[Path],
+                                      object_type: ObjectType):
+    # Same as `generate_deletions_from_merge_file`, but runs the statements right away
+    with psycopg.connect(str(settings.postgres), autocommit=True) as conn:
+        with conn.transaction(), conn.cursor() as cur:
+            execute_deletions(cur, get_ids_to_delete(merge_files), object_type=object_type)
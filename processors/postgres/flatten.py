@@ -1,28 +1,20 @@
+import math
 import logging
 import multiprocessing
 from pathlib import Path
+from typing import Callable
 
 from shared.config import settings
-from shared.util import get_globs
+from shared.util import get_globs, picklify, ObjectType
 
-from processors.postgres.deletion import generate_deletions_from_merge_file
+from processors.postgres.pgcopy import CopyFormat
+from processors.postgres.deletion import generate_deletions_from_merge_file, execute_deletions_from_merge_file
 from processors.postgres.flatten_partition import flatten_authors_partition_kw, flatten_institutions_partition_kw, \
     flatten_funder_partition_kw, flatten_concept_partition_kw, flatten_works_partition_kw, \
     flatten_publisher_partition_kw, \
     flatten_sources_partition_kw
 
 
-def picklify(params):
-    return [
-        {
-            # Path cannot be pickled, so stringify them
-            k: (str(v) if isinstance(v, Path) else v)
-            for k, v in p.items()
-        }
-        for p in params
-    ]
-
-
 def all_exist(kwargs: dict):
     # check if all kwargs of type Path already exist as a non-empty file
     return all([
@@ -32,196 +24,254 @@ def all_exist(kwargs: dict):
     ])
 
 
-def run(func, params: list[dict], parallelism: int, override: bool):
+# Flattening of one partition (or shard of it), i.e. one of the `*_kw` functions and its kwargs
+Job = tuple[Callable[[dict], None], dict]
+
+
+def run_job(job: Job):
+    func, kwargs = job
+    return func(kwargs)
+
+
+def job_size(job: Job) -> float:
+    _, kwargs = job
+    return Path(kwargs['partition']).stat().st_size / kwargs.get('n_shards', 1)
+
+
+def run(jobs: list[Job], parallelism: int, override: bool):
+    # Largest partitions go first, so they don't end up running alone while all other processes are idle.
+    # Jobs are handed out one by one (no chunks), whichever process is free takes the next.
     if not override:
-        params = [kwargs for kwargs in params if not all_exist(kwargs)]
-    if len(params) > 0:
+        jobs = [(func, kwargs) for func, kwargs in jobs if not all_exist(kwargs)]
+    jobs = sorted(jobs, key=job_size, reverse=True)
+    if len(jobs) > 0:
         if parallelism == 1:
-            for kwargs in params:
-                func(kwargs)
+            for job in jobs:
+                run_job(job)
         else:
             with multiprocessing.Pool(parallelism) as pool:
-                pool.map(func, picklify(params))
+                pickled = zip([func for func, _ in jobs], picklify([kwargs for _, kwargs in jobs]))
+                for _ in pool.imap_unordered(run_job, pickled, chunksize=1):
+                    pass
+
+
+def delete_merged(tmp_dir: Path, merge_files: list[Path], object_type: ObjectType, stream: bool = False):
+    # Merged objects are deleted right away when streaming, otherwise we write an SQL script for later
+    if stream:
+        execute_deletions_from_merge_file(merge_files=merge_files, object_type=object_type)
+    else:
+        generate_deletions_from_merge_file(merge_files=merge_files,
+                                           out_file=tmp_dir / f'pg-{object_type}-{settings.last_update}-merged_del.sql',
+                                           object_type=object_type)
 
 
-def name_part(partition: Path):
+def name_part(partition: Path, shard: int = 0, n_shards: int = 1):
     update = str(partition.parent.name).replace('updated_date=', '')
+    if n_shards > 1:
+        return f'{update}-{partition.stem}-{shard + 1}of{n_shards}'
     return f'{update}-{partition.stem}'
 
 
-def flatten_authors(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                    override: bool = False, preserve_ram: bool = True):
+def get_shards(partitions: list[Path], shard_size: int, parallelism: int) -> list[tuple[Path, int, int]]:
+    # (partition, shard, number of shards) for all partitions. Partitions larger than `shard_size` MB (gzipped) are
+    # split into shards (every n-th line), so that a few huge partitions don't keep single processes busy
+    # for hours while all others are done.
+    shards = []
+    for partition in partitions:
+        n_shards = 1
+        if shard_size > 0 and parallelism > 1:
+            n_shards = max(1, min(parallelism, math.ceil(partition.stat().st_size / (shard_size * 1024 * 1024))))
+        shards += [(partition, shard, n_shards) for shard in range(n_shards)]
+    return shards
+
+
+def authors_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+                 stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> list[Job]:
     authors, merged_authors = get_globs(settings.snapshot, settings.last_update, 'author')
 
     logging.info(f'Looks like there are {len(authors):,} author partitions '
                  f'and {len(merged_authors):,} merged_ids partitions since last update.')
-    run(flatten_authors_partition_kw,
-        [
-            {
-                'partition': partition,
-                'out_sql_cpy': tmp_dir / f'pg-author-{name_part(partition)}-cpy.sql',
-                'out_sql_del': tmp_dir / f'pg-author-{name_part(partition)}-del.sql',
-                'out_authors': tmp_dir / f'pg-author-{name_part(partition)}_authors.csv.gz',
-                'preserve_ram': preserve_ram
-            }
-            for partition in authors
-        ], parallelism=parallelism, override=override)
     if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged_authors,
-                                           out_file=tmp_dir / f'pg-author-{settings.last_update}-merged_del.sql',
-                                           object_type='author',
-                                           batch_size=1000)
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged_authors, object_type='author', stream=stream)
+
+    return [
+        (flatten_authors_partition_kw, {
+            'partition': partition,
+            'out_sql_cpy': tmp_dir / f'pg-author-{name_part(partition)}-cpy.sql',
+            'out_sql_del': None if merge else tmp_dir / f'pg-author-{name_part(partition)}-del.sql',
+            'out_authors': tmp_dir / f'pg-author-{name_part(partition)}_authors.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge
+        })
+        for partition in authors
+    ]
+
 
 
-def flatten_institutions(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                         override: bool = False, preserve_ram: bool = True):
+def institutions_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+                      stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> list[Job]:
     partitions, merged = get_globs(settings.snapshot, settings.last_update, 'institution')
     logging.info(f'Looks like there are {len(partitions):,} institution partitions '
                  f'and {len(merged):,} merged_ids partitions since last update.')
-    run(flatten_institutions_partition_kw,
-        [
-            {
-                'partition': partition,
-                'out_sql_cpy': tmp_dir / f'pg-institution-{name_part(partition)}-cpy.sql',
-                'out_sql_del': tmp_dir / f'pg-institution-{name_part(partition)}-del.sql',
-                'out_institutions': tmp_dir / f'pg-institution-{name_part(partition)}_institution.csv.gz',
-                'out_m2m_association': tmp_dir / f'pg-institution-{name_part(partition)}_institution_associations.csv.gz',
-                'out_m2m_concepts': tmp_dir / f'pg-institution-{name_part(partition)}_institution_concepts.csv.gz',
-                'preserve_ram': preserve_ram
-            }
-            for partition in partitions
-        ], parallelism=parallelism, override=override)
-
     if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged,
-                                           out_file=tmp_dir / f'pg-institution-{settings.last_update}-merged_del.sql',
-                                           object_type='institution',
-                                           batch_size=1000)
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged, object_type='institution', stream=stream)
+
+    return [
+        (flatten_institutions_partition_kw, {
+            'partition': partition,
+            'out_sql_cpy': tmp_dir / f'pg-institution-{name_part(partition)}-cpy.sql',
+            'out_sql_del': None if merge else tmp_dir / f'pg-institution-{name_part(partition)}-del.sql',
+            'out_institutions': tmp_dir / f'pg-institution-{name_part(partition)}_institution.{fmt.value}.gz',
+            'out_m2m_association': tmp_dir / f'pg-institution-{name_part(partition)}_institution_associations.{fmt.value}.gz',
+            'out_m2m_concepts': tmp_dir / f'pg-institution-{name_part(partition)}_institution_concepts.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge
+        })
+        for partition in partitions
+    ]
+
 
 
-def flatten_publishers(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                       override: bool = False, preserve_ram: bool = True):
+def publishers_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+                    stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> list[Job]:
     partitions, merged = get_globs(settings.snapshot, settings.last_update, 'publisher')
     logging.info(f'Looks like there are {len(partitions):,} publisher partitions '
                  f'and {len(merged):,} merged_ids partitions since last update.')
-    run(flatten_publisher_partition_kw, [
-        {
+    if not skip_deletion:
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged, object_type='publisher', stream=stream)
+
+    return [
+        (flatten_publisher_partition_kw, {
             'partition': partition,
             'out_sql_cpy': tmp_dir / f'pg-publisher-{name_part(partition)}-cpy.sql',
-            'out_sql_del': tmp_dir / f'pg-publisher-{name_part(partition)}-del.sql',
-            'out_publishers': tmp_dir / f'pg-publisher-{name_part(partition)}_publishers.csv.gz',
-            'preserve_ram': preserve_ram
-        }
+            'out_sql_del': None if merge else tmp_dir / f'pg-publisher-{name_part(partition)}-del.sql',
+            'out_publishers': tmp_dir / f'pg-publisher-{name_part(partition)}_publishers.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge
+        })
         for partition in partitions
-    ], parallelism=parallelism, override=override)
+    ]
 
-    if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged,
-                                           out_file=tmp_dir / f'pg-publisher-{settings.last_update}-merged_del.sql',
-                                           object_type='publisher',
-                                           batch_size=1000)
 
 
-def flatten_funders(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                    override: bool = False, preserve_ram: bool = True):
+def funders_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+                 stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> list[Job]:
     partitions, merged = get_globs(settings.snapshot, settings.last_update, 'funder')
     logging.info(f'Looks like there are {len(partitions):,} funder partitions '
                  f'and {len(merged):,} merged_ids partitions since last update.')
-    run(flatten_funder_partition_kw,
-        [
-            {
-                'partition': partition,
-                'out_sql_cpy': tmp_dir / f'pg-funder-{name_part(partition)}-cpy.sql',
-                'out_sql_del': tmp_dir / f'pg-funder-{name_part(partition)}-del.sql',
-                'out_funders': tmp_dir / f'pg-funder-{name_part(partition)}_funders.csv.gz',
-                'preserve_ram': preserve_ram
-            }
-            for partition in partitions
-        ], parallelism=parallelism, override=override)
-
     if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged,
-                                           out_file=tmp_dir / f'pg-funder-{settings.last_update}-merged_del.sql',
-                                           object_type='funder',
-                                           batch_size=1000)
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged, object_type='funder', stream=stream)
+
+    return [
+        (flatten_funder_partition_kw, {
+            'partition': partition,
+            'out_sql_cpy': tmp_dir / f'pg-funder-{name_part(partition)}-cpy.sql',
+            'out_sql_del': None if merge else tmp_dir / f'pg-funder-{name_part(partition)}-del.sql',
+            'out_funders': tmp_dir / f'pg-funder-{name_part(partition)}_funders.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge
+        })
+        for partition in partitions
+    ]
+
 
 
-def flatten_concepts(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                     override: bool = False, preserve_ram: bool = True):
+def concepts_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+                  stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> list[Job]:
     partitions, merged = get_globs(settings.snapshot, settings.last_update, 'concept')
     logging.info(f'Looks like there are {len(partitions):,} concepts partitions '
                  f'and {len(merged):,} merged_ids partitions since last update.')
-    run(flatten_concept_partition_kw,
-        [
-            {
-                'partition': partition,
-                'out_sql_cpy': tmp_dir / f'pg-concept-{name_part(partition)}-cpy.sql',
-                'out_sql_del': tmp_dir / f'pg-concept-{name_part(partition)}-del.sql',
-                'out_concepts': tmp_dir / f'pg-concept-{name_part(partition)}_concepts.csv.gz',
-                'out_m2m_ancestor': tmp_dir / f'pg-concept-{name_part(partition)}_concepts_ancestor.csv.gz',
-                'out_m2m_related': tmp_dir / f'pg-concept-{name_part(partition)}_concepts_related.csv.gz',
-                'preserve_ram': preserve_ram
-            }
-            for partition in partitions
-        ], parallelism=parallelism, override=override)
-
     if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged,
-                                           out_file=tmp_dir / f'pg-concept-{settings.last_update}-merged_del.sql',
-                                           object_type='concept',
-                                           batch_size=1000)
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged, object_type='concept', stream=stream)
+
+    return [
+        (flatten_concept_partition_kw, {
+            'partition': partition,
+            'out_sql_cpy': tmp_dir / f'pg-concept-{name_part(partition)}-cpy.sql',
+            'out_sql_del': None if merge else tmp_dir / f'pg-concept-{name_part(partition)}-del.sql',
+            'out_concepts': tmp_dir / f'pg-concept-{name_part(partition)}_concepts.{fmt.value}.gz',
+            'out_m2m_ancestor': tmp_dir / f'pg-concept-{name_part(partition)}_concepts_ancestor.{fmt.value}.gz',
+            'out_m2m_related': tmp_dir / f'pg-concept-{name_part(partition)}_concepts_related.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge
+        })
+        for partition in partitions
+    ]
+
 
 
-def flatten_sources(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                    override: bool = False, preserve_ram: bool = True):
+def sources_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+                 stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> list[Job]:
     partitions, merged = get_globs(settings.snapshot, settings.last_update, 'source')
     logging.info(f'Looks like there are {len(partitions):,} source partitions '
                  f'and {len(merged):,} merged_ids partitions since last update.')
-    run(flatten_sources_partition_kw,
-        [
-            {
-                'partition': partition,
-                'out_sql_cpy': tmp_dir / f'pg-source-{name_part(partition)}-cpy.sql',
-                'out_sql_del': tmp_dir / f'pg-source-{name_part(partition)}-del.sql',
-                'out_sources': tmp_dir / f'pg-source-{name_part(partition)}_sources.csv.gz',
-                'preserve_ram': preserve_ram
-            }
-            for partition in partitions
-        ], parallelism=parallelism, override=override)
-
     if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged,
-                                           out_file=tmp_dir / f'pg-source-{settings.last_update}-merged_del.sql',
-                                           object_type='source',
-                                           batch_size=1000)
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged, object_type='source', stream=stream)
+
+    return [
+        (flatten_sources_partition_kw, {
+            'partition': partition,
+            'out_sql_cpy': tmp_dir / f'pg-source-{name_part(partition)}-cpy.sql',
+            'out_sql_del': None if merge else tmp_dir / f'pg-source-{name_part(partition)}-del.sql',
+            'out_sources': tmp_dir / f'pg-source-{name_part(partition)}_sources.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge
+        })
+        for partition in partitions
+    ]
+
 
 
-def flatten_works(tmp_dir: Path, parallelism: int = 8, skip_deletion: bool = False,
-                  override: bool = False, preserve_ram: bool = True):
+def works_jobs(tmp_dir: Path, skip_deletion: bool = False, preserve_ram: bool = True,
+               stream: bool = False, fmt: CopyFormat = CopyFormat.csv, merge: bool = False,
+               parallelism: int = 8, shard_size: int = 512) -> list[Job]:
     partitions, merged = get_globs(settings.snapshot, settings.last_update, 'work')
     logging.info(f'Looks like there are {len(partitions):,} works partitions '
                  f'and {len(merged):,} merged_ids partitions since last update.')
-    run(flatten_works_partition_kw,
-        [
-            {
-                'partition': partition,
-                'out_sql_cpy': tmp_dir / f'pg-work-{name_part(partition)}-cpy.sql',
-                'out_sql_del': tmp_dir / f'pg-work-{name_part(partition)}-del.sql',
-                'out_works': tmp_dir / f'pg-work-{name_part(partition)}_works.csv.gz',
-                'out_m2m_locations': tmp_dir / f'pg-work-{name_part(partition)}_works_locations.csv.gz',
-                'out_m2m_concepts': tmp_dir / f'pg-work-{name_part(partition)}_works_concepts.csv.gz',
-                'out_m2m_authorships': tmp_dir / f'pg-work-{name_part(partition)}_works_authorships.csv.gz',
-                'out_m2m_authorship_institutions': tmp_dir / f'pg-work-{name_part(partition)}_works_authorship_institutions.csv.gz',
-                'out_m2m_references': tmp_dir / f'pg-work-{name_part(partition)}_works_references.csv.gz',
-                'out_m2m_related': tmp_dir / f'pg-work-{name_part(partition)}_works_related.csv.gz',
-                'out_m2m_sdgs': tmp_dir / f'pg-work-{name_part(partition)}_works_sdgs.csv.gz',
-                'preserve_ram': preserve_ram
-            }
-            for partition in partitions
-        ], parallelism=parallelism, override=override)
-
+    shards = get_shards(partitions, shard_size=shard_size, parallelism=parallelism)
+    if len(shards) > len(partitions):
+        logging.info(f'Large partitions are split, flattening {len(shards):,} shards.')
     if not skip_deletion:
-        generate_deletions_from_merge_file(merge_files=merged,
-                                           out_file=tmp_dir / f'pg-work-{settings.last_update}-merged_del.sql',
-                                           object_type='work',
-                                           batch_size=1000)
+        delete_merged(tmp_dir=tmp_dir, merge_files=merged, object_type='work', stream=stream)
+
+    return [
+        (flatten_works_partition_kw, {
+            'partition': partition,
+            'out_sql_cpy': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}-cpy.sql',
+            'out_sql_del': None if merge else tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}-del.sql',
+            'out_works': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works.{fmt.value}.gz',
+            'out_m2m_locations': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_locations.{fmt.value}.gz',
+            'out_m2m_concepts': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_concepts.{fmt.value}.gz',
+            'out_m2m_authorships': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_authorships.{fmt.value}.gz',
+            'out_m2m_authorship_institutions': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_authorship_institutions.{fmt.value}.gz',
+            'out_m2m_references': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_references.{fmt.value}.gz',
+            'out_m2m_related': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_related.{fmt.value}.gz',
+            'out_m2m_sdgs': tmp_dir / f'pg-work-{name_part(partition, shard, n_shards)}_works_sdgs.{fmt.value}.gz',
+            'preserve_ram': preserve_ram,
+            'stream': stream,
+            'skip_deletion': skip_deletion,
+            'fmt': fmt,
+            'merge': merge,
+            'shard': shard,
+            'n_shards': n_shards
+        })
+        for partition, shard, n_shards in shards
+    ]
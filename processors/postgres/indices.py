@@ -0,0 +1,80 @@
+import re
+import time
+import queue
+import logging
+import threading
+from pathlib import Path
+
+import psycopg
+
+from processors.postgres.load import connect
+
+INDICES_FILE = Path(__file__).parent.parent.parent / 'setup' / 'pg_indices.sql'
+
+
+def parse_indices(path: Path = INDICES_FILE) -> dict[str, list[str]]:
+    # Reads {table: [CREATE INDEX statements]} from `setup/pg_indices.sql`
+    with open(path, 'r') as f:
+        sql = f.read()
+    indices = {}
+    for statement in sql.split(';'):
+        statement = statement.strip()
+        match = re.match(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s.*?\sON\s+(?:ONLY\s+)?([\w.]+)', statement,
+                         flags=re.IGNORECASE | re.DOTALL)
+        if match is not None:
+            indices.setdefault(match.group(1), []).append(statement)
+    return indices
+
+
+# Builds the indexes of several tables at once (indexes of the same table one after another, they would all read
+# the whole table) and ANALYZEs the tables in `analyze` afterwards, as updates leave their statistics outdated.
+# Every connection builds one index at a time with up to `max_parallel_maintenance_workers` workers
+# (and `maintenance_work_mem` for all of them), largest tables go first.
+# Returns the tables that failed.
+def create_indices(analyze: set[str], n_connections: int = 4,
+                   session_settings: dict[str, str] | None = None,
+                   indices: dict[str, list[str]] | None = None) -> list[str]:
+    if indices is None:
+        indices = parse_indices()
+    tables = set(indices.keys()) | analyze
+    with connect() as conn:
+        # NULL for tables that don't exist (instead of an error after the indexes were dropped)
+        sizes = {table: conn.execute('SELECT pg_relation_size(to_regclass(%s))', (table,)).fetchone()[0]
+                 for table in tables}
+    failed: list[str] = []
+    for table in sorted(table for table, size in sizes.items() if size is None):
+        logging.error(f'Table {table} does not exist')
+        failed.append(table)
+        tables.remove(table)
+
+    work: queue.Queue[str] = queue.Queue()
+    for table in sorted(tables, key=lambda t: sizes[t], reverse=True):
+        work.put(table)
+
+    def build():
+        with connect(session_settings) as conn_worker:
+            while True:
+                try:
+                    table = work.get_nowait()
+                except queue.Empty:
+                    break
+                statements = indices.get(table, []) + ([f'ANALYZE {table}'] if table in analyze else [])
+                for statement in statements:
+                    start = time.time()
+                    try:
+                        conn_worker.execute(statement)
+                        logging.info(f'{statement} took {time.time() - start:.1f}s')
+                    except psycopg.Error as e:
+                        logging.error(f'Failed to run {statement}: {e}')
+                        failed.append(table)
+                        break
+
+    workers = [threading.Thread(target=build, name=f'pg-indexer-{wi}')
+               for wi in range(min(n_connections, len(tables)))]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    while not work.empty():  # left over if workers could not connect
+        failed.append(work.get_nowait())
+    return failed
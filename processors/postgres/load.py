@@ -0,0 +1,143 @@
+import re
+import time
+import logging
+import threading
+from pathlib import Path
+from itertools import takewhile
+from collections import Counter
+from typing import Generator, Iterator, NamedTuple
+
+import psycopg
+
+from shared.config import settings
+
+
+def connect(session_settings: dict[str, str] | None = None) -> psycopg.Connection:
+    # Connection with session-level settings, e.g. {'synchronous_commit': 'off', 'maintenance_work_mem': '1GB'}
+    conn = psycopg.connect(str(settings.postgres), autocommit=True)
+    for name, value in (session_settings or {}).items():
+        conn.execute('SELECT set_config(%s, %s, false)', (name, value))
+    return conn
+
+
+def iter_statements(path: Path) -> Generator[tuple[str, Iterator[str] | None], None, None]:
+    # Statements in one of our SQL scripts (see `sink.py` and `deletion.py`), which are meant for psql.
+    # `COPY ... FROM STDIN` comes with the data that follows it in the script (up to "\."), like psql reads it.
+    with open(path, 'r') as f:
+        statement = ''
+        for line in f:
+            statement += line
+            if not line.rstrip().endswith(';'):
+                continue
+            statement = statement.strip().rstrip(';')
+            if statement.upper().endswith('FROM STDIN'):
+                data = takewhile(lambda li: li.rstrip('\n') != '\\.', f)
+                yield statement, data
+                for _ in data:  # skip whatever was not consumed, so we continue after "\."
+                    pass
+            else:
+                yield statement, None
+            statement = ''
+
+
+class Script(NamedTuple):
+    path: Path
+    deletes: frozenset[str]  # tables it deletes from (or replaces rows in via upserts)
+    inserts: frozenset[str]  # tables it copies or inserts into
+
+    @property
+    def written(self) -> frozenset[str]:
+        return self.deletes | self.inserts
+
+
+def read_script(path: Path) -> Script:
+    deletes = set()
+    inserts = set()
+    for statement, _ in iter_statements(path):
+        match = re.match(rf'(COPY|DELETE FROM|INSERT INTO)\s+({settings.pg_schema}\.\w+)', statement,
+                         flags=re.IGNORECASE)
+        if match is not None:
+            if match.group(1).upper() != 'DELETE FROM':
+                inserts.add(match.group(2))
+            if match.group(1).upper() == 'DELETE FROM' or 'ON CONFLICT' in statement.upper():
+                deletes.add(match.group(2))
+    return Script(path=path, deletes=frozenset(deletes), inserts=frozenset(inserts))
+
+
+def execute_script(conn: psycopg.Connection, path: Path):
+    # Everything in a script happens in one transaction (scripts may also say so themselves)
+    with conn.transaction(), conn.cursor() as cur:
+        for statement, data in iter_statements(path):
+            if statement.upper() in {'BEGIN', 'COMMIT'}:
+                continue
+            if data is None:
+                cur.execute(statement)
+            else:
+                with cur.copy(statement) as copy:
+                    for line in data:
+                        copy.write(line)
+
+
+# Runs SQL scripts over `n_connections` connections (one worker thread each), so Postgres can work on several
+# partitions at once instead of one psql process after the other.
+# Scripts deleting from the same table run side by side (e.g. the deletions of all works partitions, every object is
+# in only one partition of a snapshot, so they delete different rows), as do scripts copying into the same table.
+# A script deleting from a table never runs at the same time as one inserting into it (e.g. merges, which do both,
+# upserts count as both), those keep the given order (e.g. merges of works partitions in order of their update date),
+# so rows of an object are never deleted while its newer rows are inserted.
+# Returns the tables that were changed and the scripts that failed (all others are loaded anyway).
+def load_scripts(paths: list[Path], n_connections: int = 4,
+                 session_settings: dict[str, str] | None = None) -> tuple[set[str], list[Path]]:
+    pending = [read_script(path) for path in paths]
+    busy_deletes: Counter[str] = Counter()
+    busy_inserts: Counter[str] = Counter()
+    written: set[str] = set()
+    failed: list[Path] = []
+    cond = threading.Condition()
+
+    def next_script() -> Script | None:
+        # First pending script that does not conflict with running ones, skipped scripts also reserve their tables
+        # (so they keep their order among scripts they conflict with)
+        blocked_deletes = {table for table, n in busy_deletes.items() if n > 0}
+        blocked_inserts = {table for table, n in busy_inserts.items() if n > 0}
+        for si, script in enumerate(pending):
+            if blocked_inserts.isdisjoint(script.deletes) and blocked_deletes.isdisjoint(script.inserts):
+                return pending.pop(si)
+            blocked_deletes |= script.deletes
+            blocked_inserts |= script.inserts
+        return None
+
+    def work():
+        conn = None
+        while True:
+            with cond:
+                while (script := next_script()) is None and len(pending) > 0:
+                    cond.wait()
+                if script is None:
+                    break
+                busy_deletes.update(script.deletes)
+                busy_inserts.update(script.inserts)
+            try:
+                if conn is None or conn.broken:
+                    conn = connect(session_settings)
+                start = time.time()
+                execute_script(conn, script.path)
+                written.update(script.written)
+                logging.debug(f'Loaded {script.path} in {time.time() - start:.1f}s')
+            except Exception as e:  # not only database errors (e.g. unreadable files), the worker must go on
+                logging.error(f'Failed to load {script.path}: {e}')
+                failed.append(script.path)
+            finally:
+                with cond:
+                    busy_deletes.subtract(script.deletes)
+                    busy_inserts.subtract(script.inserts)
+                    cond.notify_all()
+        if conn is not None:
+            conn.close()
+
+    workers = [threading.Thread(target=work, name=f'pg-loader-{wi}') for wi in range(n_connections)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return written, failed
@@ -0,0 +1,143 @@
+import re
+import struct
+from enum import Enum
+from pathlib import Path
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import BinaryIO, Callable, Iterable
+
+# Postgres' binary COPY format (PGCOPY), see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+# Every row is the number of fields followed by the length (-1 for NULL) and the binary representation of each value,
+# which depends on the column type, so we read those from our schema.
+
+SCHEMA_FILE = Path(__file__).parent.parent.parent / 'setup' / 'pg_schema.sql'
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)  # signature, flags, header extension length
+TRAILER = struct.pack('>h', -1)
+
+_INT = struct.Struct('>i')
+_NULL = _INT.pack(-1)
+_TRUE = struct.pack('>ib', 1, 1)
+_FALSE = struct.pack('>ib', 1, 0)
+_PG_EPOCH = datetime(2000, 1, 1)
+_MICROSECOND = timedelta(microseconds=1)
+_TEXT_OID = 25
+
+
+class CopyFormat(str, Enum):
+    csv = 'csv'
+    binary = 'binary'
+
+
+def array_literal(lst: list[str]) -> str:
+    # Text representation of an array for csv files, every element is quoted (so commas, braces, quotes, or "NULL"
+    # are kept as they are, like in binary arrays)
+    return '{' + ','.join('"' + str(li).replace('\\', '\\\\').replace('"', '\\"') + '"' for li in lst) + '}'
+
+
+def _text(v) -> bytes:
+    if v.__class__ is not str:
+        v = array_literal(v) if isinstance(v, list) else str(v)
+    b = v.encode()
+    return _INT.pack(len(b)) + b
+
+
+def _int4(v) -> bytes:
+    return struct.pack('>ii', 4, int(v))
+
+
+def _int8(v) -> bytes:
+    return struct.pack('>iq', 8, int(v))
+
+
+def _float4(v) -> bytes:
+    return struct.pack('>if', 4, float(v))
+
+
+def _bool(v) -> bytes:
+    return _TRUE if v else _FALSE
+
+
+def _timestamp(v) -> bytes:
+    # Microseconds since 2000-01-01 (OpenAlex dates look like "2023-08-01" or "2023-08-01T12:34:56.123456")
+    dt = v if isinstance(v, datetime) else datetime.fromisoformat(v).replace(tzinfo=None)
+    return struct.pack('>iq', 8, (dt - _PG_EPOCH) // _MICROSECOND)
+
+
+def _text_array(v) -> bytes:
+    # One-dimensional text[] without NULLs: dimensions, has-null flag, element type, then size and lower bound
+    # of the dimension, followed by the elements
+    if len(v) == 0:
+        payload = struct.pack('>iii', 0, 0, _TEXT_OID)
+    else:
+        items = [str(li).encode() for li in v]
+        payload = (struct.pack('>iiiii', 1, 0, _TEXT_OID, len(items), 1)
+                   + b''.join(_INT.pack(len(b)) + b for b in items))
+    return _INT.pack(len(payload)) + payload
+
+
+ENCODERS: dict[str, Callable[[object], bytes]] = {
+    'text': _text,
+    'json': _text,  # binary json is the same as text
+    'integer': _int4,
+    'int': _int4,
+    'bigint': _int8,
+    'bigserial': _int8,
+    'real': _float4,
+    'boolean': _bool,
+    'timestamp without time zone': _timestamp,
+    'text[]': _text_array,
+}
+
+
+@lru_cache
+def parse_schema(path: Path = SCHEMA_FILE) -> dict[str, dict[str, str]]:
+    # Reads {table: {column: type}} from the CREATE TABLE statements in `setup/pg_schema.sql`
+    with open(path, 'r') as f:
+        sql = f.read()
+    tables = {}
+    for table, body in re.findall(r'^CREATE TABLE \w+\.(\w+)\s*\((.*?)^\);', sql, flags=re.MULTILINE | re.DOTALL):
+        columns = {}
+        for line in body.split('\n'):
+            line = line.split('--')[0].strip().rstrip(',')
+            if len(line) == 0 or line.upper().startswith('PRIMARY KEY'):
+                continue
+            column, definition = line.split(None, 1)
+            columns[column] = re.sub(r'\s+(NOT NULL|PRIMARY KEY)', '', definition, flags=re.IGNORECASE).lower()
+        tables[table] = columns
+    return tables
+
+
+def get_encoders(table: str, fields: list[str]) -> list[Callable[[object], bytes]]:
+    columns = parse_schema()[table]
+    try:
+        return [ENCODERS[columns[field]] for field in fields]
+    except KeyError as e:
+        raise KeyError(f'No binary encoder for {table}.{e.args[0]}') from e
+
+
+# Writes rows (tuples in the order of `fieldnames`, see `TableSpec`) in binary COPY format.
+# `writeheader()` writes the PGCOPY header, `writetrailer()` has to be called at the end.
+class BinaryWriter:
+    def __init__(self, f: BinaryIO, table: str, fieldnames: list[str]):
+        self.f = f
+        self.table = table
+        self.fieldnames = fieldnames
+        self._encoders = get_encoders(table, fieldnames)
+        self._n_fields = struct.pack('>h', len(fieldnames))
+
+    def writeheader(self):
+        self.f.write(HEADER)
+
+    def writetrailer(self):
+        self.f.write(TRAILER)
+
+    def writerow(self, row: tuple):
+        values = [self._n_fields]
+        for enc, v in zip(self._encoders, row):
+            values.append(_NULL if v is None else enc(v))
+        self.f.write(b''.join(values))
+
+    def writerows(self, rows: Iterable[tuple]):
+        for row in rows:
+            self.writerow(row)
@@ -0,0 +1,227 @@
+import io
+import csv
+import gzip
+import queue
+import logging
+import threading
+from pathlib import Path
+from typing import Iterable
+
+import psycopg
+
+from processors.postgres.deletion import generate_deletions, execute_deletions
+from processors.postgres.pgcopy import CopyFormat, BinaryWriter, array_literal, HEADER, TRAILER
+from processors.postgres.staging import staging_table, create_staging_table, merge_statements
+from processors.postgres.tables import TableSpec
+from shared.config import settings
+from shared.util import ObjectType
+
+
+# Writes rows (tuples as extracted by a `TableSpec`) as csv, array columns are written as array literals
+class CsvWriter:
+    def __init__(self, f: io.TextIOBase, table: TableSpec):
+        self.writer = csv.writer(f)
+        self.fieldnames = table.fields
+        self._arrays = table.arrays
+
+    def writeheader(self):
+        self.writer.writerow(self.fieldnames)
+
+    def writerow(self, row: tuple):
+        if len(self._arrays) > 0:
+            row = list(row)
+            for ci in self._arrays:
+                if row[ci] is not None:
+                    row[ci] = array_literal(row[ci])
+        self.writer.writerow(row)
+
+    def writerows(self, rows: Iterable[tuple]):
+        if len(self._arrays) > 0:
+            for row in rows:
+                self.writerow(row)
+        else:
+            self.writer.writerows(rows)
+
+
+# Destination for the flattened rows of one partition.
+# Flatteners get one writer (`CsvWriter` or `BinaryWriter`, depending on `fmt`) per table via `writer()` and
+# call `done()` with the id of every object after all its rows are written.
+
+# Spools every table to a gzipped file and writes SQL scripts that delete the objects of this partition
+# and copy the files into Postgres later on (see `update.sh`).
+# With `merge`, there is no deletion script, the copy script merges the rows via staging tables (see `staging.py`).
+class FileSink:
+    def __init__(self, object_type: ObjectType, out_sql_cpy: Path, out_sql_del: Path | None,
+                 fmt: CopyFormat = CopyFormat.csv, merge: bool = False):
+        self.object_type = object_type
+        self.out_sql_cpy = out_sql_cpy
+        self.out_sql_del = out_sql_del
+        self.fmt = fmt
+        self.merge = merge
+        self.ids: list[str] = []
+        self._files: list[tuple[TableSpec, Path, io.IOBase, CsvWriter | BinaryWriter]] = []
+
+    def writer(self, table: TableSpec, out_file: Path) -> CsvWriter | BinaryWriter:
+        if self.fmt == CopyFormat.binary:
+            f = io.BufferedWriter(gzip.open(out_file, 'wb'), buffer_size=1 << 16)  # gzip is slow on small writes
+            writer = BinaryWriter(f, table.name, table.fields)
+        else:
+            f = gzip.open(out_file, 'wt', encoding='utf-8')
+            writer = CsvWriter(f, table)
+        writer.writeheader()
+        self._files.append((table, out_file, f, writer))
+        return writer
+
+    def done(self, oid: str):
+        self.ids.append(oid)
+
+    def close(self):
+        for _, _, f, writer in self._files:
+            if isinstance(writer, BinaryWriter):
+                writer.writetrailer()
+            f.close()
+        # Scripts are written last, so they only exist if the partition was flattened completely
+        if not self.merge:
+            with open(self.out_sql_del, 'w') as f_sql_del:
+                for del_row in generate_deletions(ids=self.ids, object_type=self.object_type):
+                    f_sql_del.write(del_row + '\n')
+        with open(self.out_sql_cpy, 'w') as f_sql_cpy:
+            options = '(FORMAT binary)' if self.fmt == CopyFormat.binary else 'csv header'
+            if self.merge:
+                f_sql_cpy.write('BEGIN;\n\n')
+            for table, out_file, _, _ in self._files:
+                if self.merge:
+                    f_sql_cpy.write(create_staging_table(table) + '\n')
+                target = staging_table(table) if self.merge else f'{settings.pg_schema}.{table.name}'
+                f_sql_cpy.write(f"COPY {target} ({','.join(table.fields)}) "
+                                f"FROM PROGRAM 'gunzip -c {out_file.absolute()}' {options};\n\n")
+            if self.merge:
+                for statement in merge_statements([table for table, _, _, _ in self._files]):
+                    f_sql_cpy.write(statement + '\n')
+                f_sql_cpy.write('\nCOMMIT;\n')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for _, _, f, _ in self._files:
+                f.close()
+
+
+# Streams rows straight into Postgres via `COPY ... FROM STDIN` while the partition is read, so nothing
+# is written to disk and the database server does not need access to our files.
+# Rows are buffered in memory for `batch_size` objects, then (in one transaction) existing rows of these
+# objects are deleted (unless `delete` is off) and all buffered tables are copied.
+# With `merge`, buffered tables are copied into staging tables and merged instead (see `staging.py`).
+# That happens in a background thread, so we can decode the next batch in the meantime; at most `queue_size`
+# batches wait for it, after that `done()` blocks.
+class StreamSink:
+    def __init__(self, object_type: ObjectType, batch_size: int = 5000, queue_size: int = 2, delete: bool = True,
+                 fmt: CopyFormat = CopyFormat.csv, merge: bool = False):
+        self.object_type = object_type
+        self.batch_size = batch_size
+        self.delete = delete
+        self.fmt = fmt
+        self.merge = merge
+        self.ids: list[str] = []
+        self._buffers: list[tuple[TableSpec, io.StringIO | io.BytesIO]] = []
+        self._error: Exception | None = None
+        self.conn = psycopg.connect(str(settings.postgres), autocommit=True)
+        self._queue: queue.Queue[tuple[list[str], list[str | bytes]] | None] = queue.Queue(maxsize=queue_size)
+        self._worker = threading.Thread(target=self._work, daemon=True, name=f'pg-stream-{object_type}')
+        self._worker.start()
+
+    def writer(self, table: TableSpec, out_file: Path | None = None) -> CsvWriter | BinaryWriter:
+        if self.fmt == CopyFormat.binary:
+            buffer = io.BytesIO()
+            writer = BinaryWriter(buffer, table.name, table.fields)  # header and trailer are added per batch
+        else:
+            buffer = io.StringIO()
+            writer = CsvWriter(buffer, table)
+        self._buffers.append((table, buffer))
+        return writer
+
+    def done(self, oid: str):
+        self.ids.append(oid)
+        if len(self.ids) >= self.batch_size:
+            self._enqueue()
+
+    def _copy(self, ids: list[str], data: list[str | bytes]):
+        options = '(FORMAT binary)' if self.fmt == CopyFormat.binary else '(FORMAT csv)'
+        with self.conn.transaction(), self.conn.cursor() as cur:
+            if self.delete and not self.merge:
+                execute_deletions(cur, ids=ids, object_type=self.object_type)
+            for (table, _), rows in zip(self._buffers, data):
+                if self.merge:
+                    cur.execute(create_staging_table(table))
+                target = staging_table(table) if self.merge else f'{settings.pg_schema}.{table.name}'
+                with cur.copy(f'COPY {target} ({",".join(table.fields)}) FROM STDIN {options}') as copy:
+                    copy.write(rows)
+            if self.merge:
+                for statement in merge_statements([table for table, _ in self._buffers]):
+                    cur.execute(statement)
+        logging.debug(f'Streamed {len(ids):,} {self.object_type}s to Postgres')
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                if self._error is None:
+                    self._copy(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _enqueue(self):
+        if self._error is not None:
+            raise self._error
+        if len(self.ids) == 0:
+            return
+        data = []
+        for _, buffer in self._buffers:
+            data.append(HEADER + buffer.getvalue() + TRAILER if self.fmt == CopyFormat.binary else buffer.getvalue())
+            buffer.seek(0)
+            buffer.truncate()
+        self._queue.put((self.ids, data))
+        self.ids = []
+
+    def flush(self):
+        # Wait until all buffered rows are in the database
+        self._enqueue()
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._worker.join()
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self._error = exc_val  # drop whatever is still queued
+            self._queue.put(None)
+            self._worker.join()
+            self.conn.close()
+
+
+def get_sink(object_type: ObjectType, out_sql_cpy: Path, out_sql_del: Path | None,
+             stream: bool = False, skip_deletion: bool = False,
+             fmt: CopyFormat = CopyFormat.csv, merge: bool = False) -> FileSink | StreamSink:
+    if stream:
+        return StreamSink(object_type, delete=not skip_deletion, fmt=fmt, merge=merge)
+    return FileSink(object_type, out_sql_cpy=out_sql_cpy, out_sql_del=out_sql_del, fmt=fmt, merge=merge)
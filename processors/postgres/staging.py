@@ -0,0 +1,41 @@
+from processors.postgres.tables import TableSpec
+from shared.config import settings
+
+# Merging rows of updated objects into the existing ones, instead of deleting all their rows first and copying
+# them again (which writes every row twice and leaves the deleted ones as dead tuples).
+# Rows are copied into staging tables first, which are temporary (not WAL-logged, only visible within the
+# transaction that copies and merges them), then the object table is upserted and the rows of all other tables
+# (e.g. authorships of works) of these objects are replaced.
+
+
+def staging_table(table: TableSpec) -> str:
+    return f'staging_{table.name}'
+
+
+def create_staging_table(table: TableSpec) -> str:
+    return (f'CREATE TEMPORARY TABLE {staging_table(table)} ON COMMIT DROP AS '
+            f'SELECT {",".join(table.fields)} FROM {settings.pg_schema}.{table.name} WITH NO DATA;')
+
+
+def merge_statements(tables: list[TableSpec]) -> list[str]:
+    # The object table (the one without `items`) decides which objects are updated. Rows in other tables have no
+    # key to match them on, so all rows of these objects are deleted before the staged ones are inserted.
+    main = next(table for table in tables if table.items is None)
+    key = main.fields[0]
+    columns = ','.join(main.fields)
+    updates = ', '.join(f'{field} = EXCLUDED.{field}' for field in main.fields[1:])
+    statements = [
+        f'ANALYZE {staging_table(main)};',
+        f'INSERT INTO {settings.pg_schema}.{main.name} ({columns}) SELECT {columns} FROM {staging_table(main)} '
+        f'ON CONFLICT ({key}) DO UPDATE SET {updates};'
+    ]
+    for table in tables:
+        if table is main:
+            continue
+        columns = ','.join(table.fields)
+        statements += [
+            f'DELETE FROM {settings.pg_schema}.{table.name} t USING {staging_table(main)} s '
+            f'WHERE t.{table.fields[0]} = s.{key};',
+            f'INSERT INTO {settings.pg_schema}.{table.name} ({columns}) SELECT {columns} FROM {staging_table(table)};'
+        ]
+    return statements
@@ -1,5 +1,5 @@
 from typing import Literal
-from msgspec import Struct
+from msgspec import Struct, Raw
 
 
 class CountsByYear(Struct, kw_only=True, omit_defaults=True):
@@ -370,7 +370,7 @@ class SustainableDevelopmentGoal(Struct, kw_only=True, omit_defaults=True):
 
 
 class Work(Struct, kw_only=True, omit_defaults=True):
-    abstract_inverted_index: dict[str, list[int]] | None = None
+    abstract_inverted_index: Raw = Raw()  # inverted directly from the raw JSON, see `invert_raw`
     authorships: list[Authorship] | None = None
     apc_list: APC | None = None
     apc_paid: APC | list[APC] | None = None
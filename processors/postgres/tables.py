@@ -0,0 +1,281 @@
+import logging
+from itertools import groupby
+from operator import attrgetter, itemgetter
+from typing import Any, Callable, NamedTuple
+
+from msgspec import DecodeError, Struct
+from msgspec.json import Encoder
+
+from processors.postgres import structs
+from shared.util import strip_id, ObjectType
+from shared.cyth.invert_index import invert_raw
+
+# Declarative description of the tables we flatten OpenAlex objects into.
+# Every column has an accessor, either a (dotted) attribute path on the object (e.g. 'summary_stats.h_index')
+# or a function of it. Columns of a table are compiled into one extractor that returns the row as a tuple
+# (the id of the object followed by the columns), which the writers in `sink.py` take as is.
+
+Accessor = str | Callable[[Any], Any]
+
+
+def prepare_list(lst: list[str] | None, strip: bool = False) -> list[str] | None:
+    # Values for array columns, the writers take care of formatting them (see `CsvWriter` and `BinaryWriter`)
+    if lst is not None and len(lst) > 0:
+        prepped = ([strip_id(li)
+                    for li in lst
+                    if li is not None and len(li) > 0] if strip else
+                   [li
+                    for li in lst
+                    if li is not None and len(li) > 0])
+        prepped = [li for li in prepped if li is not None]
+        if len(prepped) > 0:
+            return prepped
+
+    return None
+
+
+# Accessor for array columns, non-empty values of the list (or None)
+class Array:
+    def __init__(self, get: Accessor, strip: bool = False):
+        self._get = attrgetter(get) if isinstance(get, str) else get
+        self.strip = strip
+
+    def __call__(self, obj) -> list[str] | None:
+        return prepare_list(self._get(obj), strip=self.strip)
+
+
+def compile_extractor(accessors: list[Accessor]) -> Callable[[str, Any], tuple]:
+    # Builds `lambda key, obj: (key, g0(obj), *g1(obj), ...)` (like `namedtuple` does for its methods), consecutive
+    # attribute paths are read with a single `attrgetter` (which returns a tuple for multiple paths)
+    getters = {}
+    values = ['key']
+    for is_path, group in groupby(accessors, key=lambda acc: isinstance(acc, str)):
+        group = list(group)
+        if is_path and len(group) > 1:
+            name = f'g{len(getters)}'
+            getters[name] = attrgetter(*group)
+            values.append(f'*{name}(obj)')
+        else:
+            for acc in group:
+                name = f'g{len(getters)}'
+                getters[name] = attrgetter(acc) if is_path else acc
+                values.append(f'{name}(obj)')
+    return eval(f'lambda key, obj: ({", ".join(values)},)', getters)
+
+
+class TableSpec:
+    # One table, the first column (`key`) always holds the id of the object the row belongs to.
+    # Tables without `items` get one row per object, all others one row per item (e.g. per `work.concepts`,
+    # the accessors then get the item instead of the object).
+    def __init__(self, name: str, columns: list[str | tuple[str, Accessor]], key: str = 'id',
+                 items: Accessor | None = None):
+        self.name = name
+        self.fields = [key] + [col if isinstance(col, str) else col[0] for col in columns]
+        accessors = [col if isinstance(col, str) else col[1] for col in columns]
+        self.arrays = [ci + 1 for ci, acc in enumerate(accessors) if isinstance(acc, Array)]  # index in the row
+        self.extract = compile_extractor(accessors)
+        self.items = attrgetter(items) if isinstance(items, str) else items
+
+
+class EntitySpec(NamedTuple):
+    object_type: ObjectType
+    struct: type[Struct]
+    id: Callable[[Any], str | None]  # objects without id are skipped
+    tables: list[TableSpec]
+
+
+def short_id(obj) -> str | None:
+    return strip_id(obj.id)
+
+
+def ref_id(path: str) -> Callable[[Any], str | None]:
+    # Short id of the (dehydrated) object at `path`, if there is one
+    get = attrgetter(path)
+
+    def get_id(obj) -> str | None:
+        ref = get(obj)
+        return strip_id(ref.id) if ref is not None else None
+
+    return get_id
+
+
+def nth(i: int, get: Accessor) -> Callable[[Any], Any]:
+    # Accessor for items that are tuples (e.g. `(location, is_primary)`), applies `get` to the i-th value
+    get = attrgetter(get) if isinstance(get, str) else get
+    return lambda item: get(item[i])
+
+
+SUMMARY_STATS = [('h_index', 'summary_stats.h_index'), ('i10_index', 'summary_stats.i10_index')]
+
+AUTHORS = EntitySpec('author', structs.Author, id=lambda author: author.id[21:], tables=[
+    TableSpec('authors', ['cited_by_count', 'works_count', *SUMMARY_STATS,
+                          'display_name', ('display_name_alternatives', Array('display_name_alternatives')),
+                          ('id_mag', 'ids.mag'), ('id_orcid', 'ids.orcid'), ('id_scopus', 'ids.scopus'),
+                          ('id_twitter', 'ids.twitter'), ('id_wikipedia', 'ids.wikipedia'),
+                          'created_date', 'updated_date']),
+])
+
+INSTITUTIONS = EntitySpec('institution', structs.Institution, id=lambda institution: institution.id[21:], tables=[
+    TableSpec('institutions', ['type', 'homepage_url', 'cited_by_count', 'works_count', *SUMMARY_STATS,
+                               'display_name', ('display_name_alternatives', Array('display_name_alternatives')),
+                               ('display_name_acronyms', Array('display_name_acronyms')),
+                               ('id_ror', 'ror'), ('id_mag', 'ids.mag'), ('id_wikipedia', 'ids.wikipedia'),
+                               ('id_wikidata', 'ids.wikidata'), ('id_grid', 'ids.grid'),
+                               ('city', 'geo.city'), ('geonames_city_id', 'geo.geonames_city_id'),
+                               ('region', 'geo.region'), ('country', 'geo.country'),
+                               ('country_code', 'geo.country_code'),
+                               ('latitude', 'geo.latitude'), ('longitude', 'geo.longitude'),
+                               'created_date', 'updated_date']),
+    TableSpec('institutions_associations', [('institution_b_id', lambda ass: ass.id[21:]), 'relationship'],
+              key='institution_a_id', items='associated_institutions'),
+    TableSpec('institutions_concepts', [('concept_id', lambda con: con.id[21:]), 'score'],
+              key='institution_id', items='x_concepts'),
+])
+
+PUBLISHERS = EntitySpec('publisher', structs.Publisher, id=short_id, tables=[
+    TableSpec('publishers', ['cited_by_count', 'works_count', *SUMMARY_STATS,
+                             'display_name', ('alternate_titles', Array('alternate_titles')),
+                             ('country_codes', Array('country_codes')),
+                             ('id_ror', 'ids.ror'), ('id_wikidata', 'ids.wikidata'),
+                             'hierarchy_level', ('lineage', Array('lineage', strip=True)),
+                             ('parent', ref_id('parent_publisher')),
+                             'created_date', 'updated_date']),
+])
+
+FUNDERS = EntitySpec('funder', structs.Funder, id=short_id, tables=[
+    TableSpec('funders', ['cited_by_count', 'works_count', *SUMMARY_STATS,
+                          'display_name', ('alternate_titles', Array('alternate_titles')), 'description',
+                          'homepage_url', ('id_ror', 'ids.ror'), ('id_wikidata', 'ids.wikidata'),
+                          ('id_crossref', 'ids.crossref'), ('id_doi', 'ids.doi'),
+                          'created_date', 'updated_date']),
+])
+
+CONCEPTS = EntitySpec('concept', structs.Concept, id=short_id, tables=[
+    TableSpec('concepts', ['cited_by_count', 'works_count', *SUMMARY_STATS,
+                           'display_name', 'description', 'level',
+                           ('id_mag', 'ids.mag'), ('id_umls_cui', Array('ids.umls_cui')),
+                           ('id_umls_aui', Array('ids.umls_aui')),
+                           ('id_wikidata', 'ids.wikidata'), ('id_wikipedia', 'ids.wikipedia'),
+                           'created_date', 'updated_date']),
+    TableSpec('concepts_ancestors', [('concept_b_id', short_id)], key='concept_a_id', items='ancestors'),
+    TableSpec('concepts_related', [('concept_b_id', short_id), 'score'], key='concept_a_id', items='related_concepts'),
+])
+
+SOURCES = EntitySpec('source', structs.Source, id=short_id, tables=[
+    TableSpec('sources', ['cited_by_count', 'works_count', *SUMMARY_STATS,
+                          'display_name', 'abbreviated_title', ('alternate_titles', Array('alternate_titles')),
+                          'country_code', 'homepage_url', 'type', 'apc_usd',
+                          'host_organization', 'host_organization_name',
+                          ('host_organization_lineage', Array('host_organization_lineage', strip=True)),
+                          ('societies', Array(lambda source: ([s.organization for s in source.societies]
+                                                              if source.societies is not None else None))),
+                          'is_in_doaj', 'is_oa',
+                          ('id_mag', 'ids.mag'), ('id_fatcat', 'ids.fatcat'), ('id_issn', Array('ids.issn')),
+                          ('id_issn_l', 'ids.issn_l'), ('id_wikidata', 'ids.wikidata'),
+                          'created_date', 'updated_date']),
+])
+
+_json = Encoder()
+
+
+def _abstract(work: structs.Work) -> str | None:
+    try:
+        abstract = invert_raw(work.abstract_inverted_index)
+    except DecodeError:
+        logging.warning(f'Failed to read abstract for {work.id}')
+        return None
+    if abstract is not None and len(abstract.strip()) > 0:
+        return abstract
+    return None
+
+
+def _primary_source(work: structs.Work) -> str | None:
+    if work.primary_location is not None and work.primary_location.source is not None:
+        return strip_id(work.primary_location.source.id)
+    return None
+
+
+def _mesh(work: structs.Work) -> str | None:
+    if work.mesh is not None and len(work.mesh) > 0:
+        return _json.encode(work.mesh).decode()
+    return None
+
+
+def _grants(work: structs.Work) -> str | None:
+    if work.grants is not None and len(work.grants) > 0:
+        return _json.encode([{
+            'funder': strip_id(g.funder),
+            'funder_display_name': g.funder_display_name,
+            'award_id': g.award_id
+        } for g in work.grants]).decode()
+    return None
+
+
+def _locations(work: structs.Work) -> list[tuple[structs.Location, bool]] | None:
+    # (location, is_primary) for all locations of the work
+    if work.locations is None:
+        return None
+    primary = work.primary_location
+    if primary is None or primary.source is None:
+        return [(location, False) for location in work.locations]
+    return [(location, (location.source is not None
+                        and primary.source.id == location.source.id
+                        and primary.source.display_name == location.source.display_name
+                        and primary.pdf_url == location.pdf_url
+                        and primary.version == location.version))
+            for location in work.locations]
+
+
+def _authorships(work: structs.Work) -> enumerate | None:
+    # (position in the list, authorship) for all authors
+    return enumerate(work.authorships) if work.authorships is not None else None
+
+
+def _authorship_institutions(work: structs.Work) -> list[tuple[str | None, str | None]] | None:
+    # (author id, institution id) for all affiliations of all authors
+    if work.authorships is None:
+        return None
+    return [(_author_id(authorship), strip_id(institution.id))
+            for authorship in work.authorships
+            if authorship.institutions is not None
+            for institution in authorship.institutions]
+
+
+_author_id = ref_id('author')
+_source_id = ref_id('source')
+
+WORKS = EntitySpec('work', structs.Work, id=short_id, tables=[
+    TableSpec('works', ['title', ('abstract', _abstract), 'display_name', 'language',
+                        'publication_date', 'publication_year',
+                        ('volume', 'biblio.volume'), ('issue', 'biblio.issue'),
+                        ('first_page', 'biblio.first_page'), ('last_page', 'biblio.last_page'),
+                        ('primary_location', _primary_source), 'type', 'type_crossref',
+                        ('id_doi', 'ids.doi'), ('id_mag', 'ids.mag'), ('id_pmid', 'ids.pmid'),
+                        ('id_pmcid', 'ids.pmcid'),
+                        'is_oa', ('oa_status', 'open_access.oa_status'), ('oa_url', 'open_access.oa_url'),
+                        ('oa_any_repository_has_fulltext', 'open_access.any_repository_has_fulltext'),
+                        ('apc_paid', lambda work: (work.apc_paid.value_usd
+                                                   if work.apc_paid is not None
+                                                      and not isinstance(work.apc_paid, list) else None)),
+                        ('apc_list', lambda work: work.apc_list.value_usd if work.apc_list is not None else None),
+                        'license', 'cited_by_count', 'is_paratext', 'is_retracted',
+                        ('mesh', _mesh), ('grants', _grants),
+                        'created_date', 'updated_date']),
+    TableSpec('works_locations', [('source_id', nth(0, _source_id)), ('is_oa', nth(0, 'is_oa')),
+                                  ('is_primary', itemgetter(1)), ('landing_page_url', nth(0, 'landing_page_url')),
+                                  ('license', nth(0, 'license')), ('pdf_url', nth(0, 'pdf_url')),
+                                  ('version', nth(0, 'version'))],
+              key='work_id', items=_locations),
+    TableSpec('works_concepts', [('concept_id', short_id), 'score'], key='work_id', items='concepts'),
+    TableSpec('works_authorships', [('author_id', nth(1, _author_id)), ('position', nth(1, 'author_position')),
+                                    ('exact_position', itemgetter(0)), ('raw_author_name', nth(1, 'raw_author_name')),
+                                    ('raw_affiliation', nth(1, 'raw_affiliation_string')),
+                                    ('is_corresponding', nth(1, 'is_corresponding'))],
+              key='work_id', items=_authorships),
+    TableSpec('works_authorship_institutions', [('author_id', itemgetter(0)), ('institution_id', itemgetter(1))],
+              key='work_id', items=_authorship_institutions),
+    TableSpec('works_references', [('work_b_id', strip_id)], key='work_a_id', items='referenced_works'),
+    TableSpec('works_related', [('work_b_id', strip_id)], key='work_a_id', items='related_works'),
+    TableSpec('works_sdgs', [('sdg_id', 'id'), 'display_name', 'score'],
+              key='work_id', items='sustainable_development_goals'),
+])
@@ -0,0 +1,78 @@
+import json
+import time
+import logging
+import http.client
+from urllib.parse import urlsplit, urlencode
+
+from processors.solr.indexer import SolrError
+
+
+def split_url(url: str) -> tuple[str, str]:
+    # http://localhost:8983/solr/openalex -> (http://localhost:8983/solr, openalex)
+    base, collection = url.rstrip('/').rsplit('/', 1)
+    return base, collection
+
+
+def request(url: str, path: str, params: dict, body: bytes | None = None, timeout: float | None = 600) -> dict:
+    # Single JSON request to `path` relative to `url` (GET, or POST if there is a `body`)
+    parts = urlsplit(url)
+    conn = http.client.HTTPConnection(parts.hostname, parts.port or 80, timeout=timeout)
+    try:
+        conn.request('GET' if body is None else 'POST',
+                     f'{parts.path.rstrip("/")}{path}?{urlencode({**params, "wt": "json"})}',
+                     body=body, headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        payload = response.read()
+    finally:
+        conn.close()
+    if response.status >= 400:
+        raise SolrError(f'Request to {url}{path} failed ({response.status}): {payload[:1000]!r}',
+                        status=response.status)
+    return json.loads(payload)
+
+
+def collections_api(base_url: str, timeout: float = 600, **params) -> dict:
+    # Collections API of the Solr node at `base_url` (e.g. http://localhost:8983/solr)
+    return request(base_url, '/admin/collections', params, timeout=timeout)
+
+
+def cluster_status(base_url: str, collection: str) -> dict:
+    return collections_api(base_url, action='CLUSTERSTATUS', collection=collection)['cluster']['collections'][collection]
+
+
+def list_collections(base_url: str) -> list[str]:
+    return collections_api(base_url, action='LIST')['collections']
+
+
+def list_aliases(base_url: str) -> dict[str, list[str]]:
+    return {alias: collections.split(',')
+            for alias, collections in collections_api(base_url, action='LISTALIASES').get('aliases', {}).items()}
+
+
+def create_collection(base_url: str, name: str, config_name: str, num_shards: int = 1, replication_factor: int = 1):
+    logging.info(f'Creating Solr collection "{name}" from configset "{config_name}" '
+                 f'with {num_shards} shards and {replication_factor} replicas')
+    collections_api(base_url, action='CREATE', name=name, **{'collection.configName': config_name,
+                                                             'numShards': num_shards,
+                                                             'replicationFactor': replication_factor})
+
+
+def count_segments(url: str) -> int:
+    # Number of segments in the index behind `url` (e.g. http://localhost:8983/solr/openalex).
+    # For collections with multiple shards, this is the number of segments in the replica that answered.
+    return len(request(url, '/admin/segments', {})['segments'])
+
+
+def optimize(url: str, max_segments: int) -> float:
+    # Merges the index behind `url` down to at most `max_segments` segments (blocks until done, which may
+    # take very long) and returns the duration in seconds
+    start = time.time()
+    request(url, '/update', {'waitSearcher': 'true'},
+            body=json.dumps({'optimize': {'maxSegments': max_segments}}).encode(), timeout=None)
+    return time.time() - start
+
+
+def create_alias(base_url: str, alias: str, collections: list[str]):
+    # Creates the alias or replaces the collections it points to
+    logging.info(f'Pointing Solr alias "{alias}" to {", ".join(collections)}')
+    collections_api(base_url, action='CREATEALIAS', name=alias, collections=','.join(collections))
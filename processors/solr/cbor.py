@@ -0,0 +1,113 @@
+import struct
+from typing import BinaryIO, Generator
+
+from msgspec import Struct
+
+# Minimal CBOR (RFC 8949) support for the flat documents we send to Solr's /update/cbor handler,
+# i.e. maps of strings to strings, ints, bools (and null). Nested objects are JSON strings anyway.
+
+_TRUE = b'\xf5'
+_FALSE = b'\xf4'
+_NULL = b'\xf6'
+
+
+def head(major: int, n: int) -> bytes:
+    # Initial byte(s) of a data item with major type `major` and argument `n`
+    major <<= 5
+    if n < 24:
+        return bytes((major | n,))
+    if n < 0x100:
+        return struct.pack('>BB', major | 24, n)
+    if n < 0x10000:
+        return struct.pack('>BH', major | 25, n)
+    if n < 0x100000000:
+        return struct.pack('>BI', major | 26, n)
+    return struct.pack('>BQ', major | 27, n)
+
+
+def encode_str(s: str) -> bytes:
+    b = s.encode()
+    return head(3, len(b)) + b
+
+
+def encode_value(v) -> bytes:
+    if v is None:
+        return _NULL
+    if v is True:
+        return _TRUE
+    if v is False:
+        return _FALSE
+    if isinstance(v, int):
+        return head(0, v) if v >= 0 else head(1, -1 - v)
+    if isinstance(v, str):
+        return encode_str(v)
+    raise TypeError(f'Unsupported type for CBOR: {type(v)}')
+
+
+class Encoder:
+    # Encodes structs as CBOR maps, dropping fields that are None (like `omit_defaults` does for JSON)
+    def __init__(self):
+        self._keys: dict[str, bytes] = {}
+
+    def encode(self, obj: Struct) -> bytes:
+        items = []
+        for field in obj.__struct_fields__:
+            v = getattr(obj, field)
+            if v is None:
+                continue
+            key = self._keys.get(field)
+            if key is None:
+                key = self._keys[field] = encode_str(field)
+            items.append(key)
+            items.append(encode_value(v))
+        return head(5, len(items) // 2) + b''.join(items)
+
+
+def array(items: list[bytes]) -> bytes:
+    return head(4, len(items)) + b''.join(items)
+
+
+def frame(doc: bytes) -> bytes:
+    # CBOR files are a sequence of length-prefixed documents, so they can be batched without decoding
+    return struct.pack('>I', len(doc)) + doc
+
+
+def read_frames(f: BinaryIO) -> Generator[bytes, None, None]:
+    while len(size := f.read(4)) == 4:
+        yield f.read(struct.unpack('>I', size)[0])
+
+
+def _decode_head(buf: bytes, i: int) -> tuple[int, int, int]:
+    # Returns major type, argument and the position behind the head
+    major, n = buf[i] >> 5, buf[i] & 0x1f
+    i += 1
+    if n >= 24 and major != 7:
+        size = 1 << (n - 24)
+        n = int.from_bytes(buf[i:i + size], 'big')
+        i += size
+    return major, n, i
+
+
+def _decode_item(buf: bytes, i: int) -> tuple[object, int]:
+    major, n, i = _decode_head(buf, i)
+    if major == 0:
+        return n, i
+    if major == 1:
+        return -1 - n, i
+    if major == 3:
+        return buf[i:i + n].decode(), i + n
+    if major == 7 and n in {20, 21, 22}:
+        return {20: False, 21: True, 22: None}[n], i
+    raise ValueError(f'Unsupported CBOR item (major type {major})')
+
+
+def decode_map(buf: bytes) -> dict:
+    # Decodes a flat map as written by `Encoder` (we only need this for routing documents)
+    major, n, i = _decode_head(buf, 0)
+    if major != 5:
+        raise ValueError('Expected a CBOR map')
+    result = {}
+    for _ in range(n):
+        key, i = _decode_item(buf, i)
+        result[key], i = _decode_item(buf, i)
+    return result
@@ -0,0 +1,245 @@
+import bisect
+import logging
+import http.client
+from abc import ABC, abstractmethod
+
+from msgspec import Struct
+from msgspec.json import Decoder, Encoder
+
+from shared.cyth.murmur import murmurhash3_x86_32
+from processors.solr import structs, cbor
+from processors.solr.admin import split_url, cluster_status, list_collections, list_aliases, create_collection, \
+    create_alias
+from processors.solr.indexer import SolrIndexer, SolrError, CommitStrategy, DocumentFormat
+
+
+class RoutingKey(Struct):
+    # Only fields needed for routing are decoded from a document, all others are skipped
+    id: str
+    publication_year: int | None = None
+
+
+def parse_range(hash_range: str) -> tuple[int, int]:
+    # Solr writes shard ranges as hex, e.g. "80000000-ffffffff", which are signed 32bit ints in Java
+    def to_int(h: str) -> int:
+        v = int(h, 16)
+        return v - (1 << 32) if v >= (1 << 31) else v
+
+    lo, hi = hash_range.split('-')
+    return to_int(lo), to_int(hi)
+
+
+def composite_hash(doc_id: str) -> int:
+    # Same as Solr's CompositeIdRouter for plain ids ("W123") and "shardkey!id"
+    if '!' in doc_id:
+        shard_key, rest = doc_id.split('!', 1)
+        hi = murmurhash3_x86_32(shard_key.encode()) & 0xffff0000
+        lo = murmurhash3_x86_32(rest.encode()) & 0x0000ffff
+        v = hi | lo
+        return v - (1 << 32) if v >= (1 << 31) else v
+    return murmurhash3_x86_32(doc_id.encode())
+
+
+def get_shard_leaders(url: str) -> list[tuple[int, int, str]]:
+    # Reads the cluster state of the collection behind `url` (e.g. http://localhost:8983/solr/openalex)
+    # and returns (range min, range max, leader core url) for every active shard.
+    base_url, collection = split_url(url)
+    state = cluster_status(base_url, collection)
+    router = state.get('router', {}).get('name')
+    if router != 'compositeId':
+        raise SolrError(f'Collection "{collection}" uses the "{router}" router, only compositeId is supported')
+
+    leaders = []
+    for shard_name, shard in state['shards'].items():
+        if shard.get('state') != 'active':
+            continue
+        leader = [replica for replica in shard['replicas'].values() if replica.get('leader') == 'true']
+        if len(leader) == 0:
+            raise SolrError(f'Shard "{shard_name}" has no leader right now')
+        lo, hi = parse_range(shard['range'])
+        leaders.append((lo, hi, f'{leader[0]["base_url"]}/{leader[0]["core"]}'))
+    return sorted(leaders)
+
+
+# Distributes documents across several `SolrIndexer`s (each with its own connections and queue).
+# Implementations decide which target a document goes to, deletions and commits go to `url`.
+class RoutingIndexer(SolrIndexer, ABC):
+    def __init__(self, url: str, n_connections: int = 4, **kwargs):
+        super().__init__(url, n_connections=0, **kwargs)
+        self._decoder = Decoder(RoutingKey)
+        self._targets: list[SolrIndexer] = []
+        # Targets never commit on their own, we do that for all of them
+        self._target_kwargs = {**kwargs,
+                               'n_connections': n_connections,
+                               'commit_strategy': (CommitStrategy.within
+                                                   if self.commit_strategy == CommitStrategy.within
+                                                   else CommitStrategy.end)}
+
+    @abstractmethod
+    def _route(self, key: RoutingKey, doc: bytes) -> int:
+        # Index of the target in `self._targets` the document goes to
+        ...
+
+    def _key(self, doc: bytes, fmt: DocumentFormat) -> RoutingKey:
+        if fmt == DocumentFormat.cbor:
+            values = cbor.decode_map(doc)
+            return RoutingKey(id=values['id'], publication_year=values.get('publication_year'))
+        return self._decoder.decode(doc)
+
+    def add(self, doc: bytes, atomic: bool = False, fmt: DocumentFormat = DocumentFormat.json):
+        self._targets[self._route(self._key(doc, fmt), doc)].add(doc, atomic=atomic, fmt=fmt)
+        self.n_docs += 1
+        if self.commit_strategy == CommitStrategy.soft and self.n_docs % self.batch_size == 0:
+            self._maybe_soft_commit()
+
+    def flush(self):
+        failed = 0
+        for target in self._targets:
+            try:
+                target.flush()
+            except SolrError:
+                failed += target.n_failed
+        self.n_batches = sum(target.n_batches for target in self._targets)
+        if failed > 0:
+            raise SolrError(f'{failed:,} batches failed to post to Solr')
+        super().flush()
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            for target in self._targets:
+                try:
+                    target.close()
+                except SolrError:
+                    pass  # already raised by `flush()`
+
+
+# Posts every document directly to the leader of the shard it belongs to, instead of letting one node forward
+# everything. Documents are hashed like Solr's compositeId router does.
+class ShardedIndexer(RoutingIndexer):
+    def __init__(self, url: str, leaders: list[tuple[int, int, str]], **kwargs):
+        super().__init__(url, **kwargs)
+        self._range_starts = [lo for lo, _, _ in leaders]
+        self._range_ends = [hi for _, hi, _ in leaders]
+        self._targets = [SolrIndexer(leader_url, **self._target_kwargs) for _, _, leader_url in leaders]
+        for _, _, leader_url in leaders:
+            logging.info(f'Posting to shard leader {leader_url}')
+
+    def _route(self, key: RoutingKey, doc: bytes) -> int:
+        h = composite_hash(key.id)
+        li = bisect.bisect_right(self._range_starts, h) - 1
+        if li < 0 or h > self._range_ends[li]:
+            raise SolrError(f'No shard covers hash {h} of document {doc[:100]!r}')
+        return li
+
+
+# Names of per-period collections: one for everything before the first year in `split_years`,
+# one starting at each of the years (the last one holds all recent works), and one for works without a year.
+class Periods:
+    def __init__(self, collection: str, split_years: list[int]):
+        self.split_years = sorted(split_years)
+        self.names = ([f'{collection}_pre{self.split_years[0]}']
+                      + [f'{collection}_{year}' for year in self.split_years]
+                      + [f'{collection}_undated'])
+
+    def index(self, year: int | None) -> int:
+        if year is None:
+            return len(self.names) - 1
+        return bisect.bisect_right(self.split_years, year)
+
+
+# Posts works to the collection for their `publication_year` (see `Periods`), which are queried via an alias,
+# so that updates (mostly recent works) only cause merges in the small collections for recent years.
+# Works can move to another period when their year changes, so every work is deleted from all other
+# collections after each partition (unless `remove_moved` is off, e.g. for an import into empty collections).
+# Deletions and commits go to all collections.
+class PeriodIndexer(RoutingIndexer):
+    def __init__(self, url: str, periods: Periods, route_to_leaders: bool = False, remove_moved: bool = True,
+                 **kwargs):
+        super().__init__(url, **kwargs)
+        base_url, _ = split_url(url)
+        self.periods = periods
+        self.remove_moved = remove_moved
+        self._targets = [get_indexer(f'{base_url}/{name}', route_to_leaders=route_to_leaders,
+                                     **self._target_kwargs)
+                         for name in periods.names]
+        self._decoder_counters = Decoder(structs.WorkCountersOut)
+        self._encoder = Encoder()
+        self._posted: list[tuple[str, int]] = []  # (id, target) of documents posted since the last cleanup
+
+    def _route(self, key: RoutingKey, doc: bytes) -> int:
+        return self.periods.index(key.publication_year)
+
+    def add(self, doc: bytes, atomic: bool = False, fmt: DocumentFormat = DocumentFormat.json):
+        # Same as `RoutingIndexer.add`, but we need to remember where each work went (and fix atomic updates)
+        key = self._key(doc, fmt)
+        ti = self._route(key, doc)
+        if atomic:
+            # The year is only in there for routing and would break in-place updates
+            counters = self._decoder_counters.decode(doc)
+            counters.publication_year = None
+            doc = self._encoder.encode(counters)
+        elif self.remove_moved:
+            self._posted.append((key.id, ti))
+        self._targets[ti].add(doc, atomic=atomic, fmt=fmt)
+        self.n_docs += 1
+        if self.commit_strategy == CommitStrategy.soft and self.n_docs % self.batch_size == 0:
+            self._maybe_soft_commit()
+
+    def _remove_elsewhere(self):
+        if len(self._posted) == 0:
+            return
+        for ti, target in enumerate(self._targets):
+            target.delete_ids([wid for wid, wti in self._posted if wti != ti])
+        logging.debug(f'Removed {len(self._posted):,} works from collections of other periods')
+        self._posted = []
+
+    def flush(self):
+        super().flush()
+        self._remove_elsewhere()
+
+    def partition_done(self):
+        # Make sure all works of this partition are removed from other periods before the next partition
+        # (which might contain the same work again) is posted
+        self.flush()
+        super().partition_done()
+
+    def update(self, body: bytes, content_type: str = 'application/json', params: dict | None = None) -> bytes:
+        response = b''
+        for target in self._targets:
+            response = target.update(body, content_type=content_type, params=params)
+        return response
+
+
+def ensure_periods(url: str, periods: Periods, config_name: str, num_shards: int = 1, replication_factor: int = 1):
+    # Creates missing per-period collections and points the alias (collection name in `url`) to all of them.
+    # While the alias name is still taken by a single collection (migrating to periods, see README), the per-period
+    # collections are only created (and then filled by a full import), queries keep going to the old collection.
+    base_url, alias = split_url(url)
+    existing = set(list_collections(base_url))
+    for name in periods.names:
+        if name not in existing:
+            create_collection(base_url, name, config_name, num_shards=num_shards, replication_factor=replication_factor)
+    if alias in existing:
+        logging.warning(f'"{alias}" is a collection, so it can not be an alias for the per-period collections yet. '
+                        f'Delete it once they hold all works and run again to create the alias.')
+    elif list_aliases(base_url).get(alias) != periods.names:
+        create_alias(base_url, alias, periods.names)
+
+
+def get_indexer(url: str,
+                route_to_leaders: bool = False,
+                periods: Periods | None = None,
+                remove_moved: bool = True,
+                **kwargs) -> SolrIndexer:
+    # Sends documents to per-period collections if asked to, and straight to the shard leaders if asked to and
+    # possible, otherwise everything goes to `url`
+    if periods is not None:
+        return PeriodIndexer(url, periods, route_to_leaders=route_to_leaders, remove_moved=remove_moved, **kwargs)
+    if route_to_leaders:
+        try:
+            return ShardedIndexer(url, get_shard_leaders(url), **kwargs)
+        except (OSError, http.client.HTTPException, SolrError, KeyError) as e:
+            logging.warning(f'Unable to route documents to shard leaders ({e}), posting everything to {url}')
+    return SolrIndexer(url, **kwargs)
@@ -0,0 +1,66 @@
+import sqlite3
+import hashlib
+from pathlib import Path
+from typing import Iterable
+
+from shared.util import batched
+
+
+def fingerprint(doc: bytes | bytearray) -> bytes:
+    return hashlib.blake2b(doc, digest_size=16).digest()
+
+
+# Persistent mapping of work id -> fingerprints of the document we last sent to Solr.
+# `fingerprint` covers the entire document, `content` everything except the counters that can be
+# updated in-place (see `transform_partition`).
+# Transformers only read from it (many processes at once), the updater writes new
+# fingerprints once the respective documents are committed in Solr.
+class FingerprintStore:
+    def __init__(self, path: Path | str, readonly: bool = False):
+        self.path = Path(path)
+        if readonly:
+            self.conn = sqlite3.connect(f'file:{self.path.absolute()}?mode=ro', uri=True)
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.conn = sqlite3.connect(self.path)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                              '  id TEXT PRIMARY KEY,'
+                              '  fingerprint BLOB NOT NULL,'
+                              '  content BLOB'
+                              ') WITHOUT ROWID')
+            # Stores from before we tracked content fingerprints
+            columns = {row[1] for row in self.conn.execute('PRAGMA table_info(fingerprints)')}
+            if 'content' not in columns:
+                self.conn.execute('ALTER TABLE fingerprints ADD COLUMN content BLOB')
+            self.conn.commit()
+
+    def get(self, wid: str) -> tuple[bytes, bytes | None] | None:
+        # Returns (fingerprint, content fingerprint) or None if we never saw this work
+        return self.conn.execute('SELECT fingerprint, content FROM fingerprints WHERE id = ?', (wid,)).fetchone()
+
+    def update(self, fingerprints: Iterable[tuple[str, bytes, bytes]]) -> int:
+        cur = self.conn.executemany('INSERT OR REPLACE INTO fingerprints (id, fingerprint, content) VALUES (?, ?, ?)',
+                                    fingerprints)
+        self.conn.commit()
+        return cur.rowcount
+
+    def update_from_file(self, path: Path | str) -> int:
+        # Reads fingerprints as written by `transform_partition` (one `id<TAB>hex fingerprint<TAB>hex content` per line)
+        with open(path, 'r') as f:
+            return self.update((wid, bytes.fromhex(fp), bytes.fromhex(content))
+                               for wid, fp, content in (line.rstrip('\n').split('\t') for line in f))
+
+    def delete(self, ids: Iterable[str]) -> None:
+        for del_batch in batched(ids, 10000):
+            self.conn.executemany('DELETE FROM fingerprints WHERE id = ?', ((wid,) for wid in del_batch))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
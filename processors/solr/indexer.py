@@ -0,0 +1,272 @@
+import time
+import queue
+import logging
+import threading
+import http.client
+from enum import Enum
+from pathlib import Path
+from typing import Iterable
+from urllib.parse import urlsplit, urlencode
+
+from msgspec.json import Encoder
+
+from shared.util import batched
+from processors.solr import cbor
+
+
+class SolrError(Exception):
+    def __init__(self, message: str, status: int | None = None):
+        super().__init__(message)
+        self.status = status
+
+
+class CommitStrategy(str, Enum):
+    partition = 'partition'  # hard commit after every partition
+    within = 'within'  # let Solr commit within `commit_within` ms after an update
+    soft = 'soft'  # soft commit every `soft_commit_interval` seconds
+    end = 'end'  # only commit once all updates are posted
+
+
+class DocumentFormat(str, Enum):
+    json = 'json'  # JSON lines, posted to /update/json/docs
+    cbor = 'cbor'  # length-prefixed CBOR maps, posted to /update/cbor (Solr 9.3+)
+
+
+# Streams JSON documents to a Solr collection over keep-alive HTTP connections.
+# Documents are collected into batches, which are posted by `n_connections` worker threads (one connection each).
+# Atomic updates (e.g. {"id": .., "field": {"set": ..}}) are batched separately and posted to /update.
+# Documents can also be CBOR encoded (see `processors.solr.cbor`), which are batched into CBOR arrays.
+# At most `queue_size` batches wait for a free connection, after that `add()` blocks (backpressure).
+# Failed batches are retried `max_retries` times with exponential backoff before they are reported as failed.
+class SolrIndexer:
+    def __init__(self,
+                 url: str,  # Solr collection url, e.g. http://localhost:8983/solr/openalex
+                 batch_size: int = 5000,  # maximum number of documents per batch
+                 batch_bytes: int = 32 * 1024 * 1024,  # maximum payload size per batch
+                 n_connections: int = 4,
+                 queue_size: int = 8,
+                 max_retries: int = 5,
+                 timeout: float = 600,
+                 commit_strategy: CommitStrategy = CommitStrategy.end,
+                 commit_within: int = 60000,  # in ms, only used by CommitStrategy.within
+                 soft_commit_interval: float = 60):  # in s, only used by CommitStrategy.soft
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path.rstrip('/')
+
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+        self.commit_strategy = commit_strategy
+        self.commit_within = commit_within
+        self.soft_commit_interval = soft_commit_interval
+        self._last_soft_commit = time.time()
+
+        self.n_docs = 0
+        self.n_batches = 0
+        self.n_failed = 0
+        self.n_commits = 0
+        self.commit_time = 0.
+
+        # Pending batches per handler path
+        self._batches: dict[str, list[bytes]] = {}
+        self._batch_lens: dict[str, int] = {}
+        self._queue: queue.Queue[tuple[str, bytes, str] | None] = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._conn: http.client.HTTPConnection | None = None  # connection for synchronous requests
+        self._workers = [threading.Thread(target=self._work, daemon=True, name=f'solr-indexer-{wi}')
+                         for wi in range(n_connections)]
+        for worker in self._workers:
+            worker.start()
+
+    def _connect(self) -> http.client.HTTPConnection:
+        return http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+
+    def _request(self, conn: http.client.HTTPConnection, path: str, body: bytes, content_type: str) -> bytes:
+        conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+        response = conn.getresponse()
+        payload = response.read()  # always read the full response, so the connection can be reused
+        if response.status >= 400:
+            raise SolrError(f'Solr responded with {response.status} {response.reason}: {payload[:1000]!r}',
+                            status=response.status)
+        return payload
+
+    def _request_retry(self,
+                       conn: http.client.HTTPConnection | None,
+                       path: str,
+                       body: bytes,
+                       content_type: str) -> tuple[http.client.HTTPConnection, bytes]:
+        for attempt in range(self.max_retries + 1):
+            if conn is None:
+                conn = self._connect()
+            try:
+                return conn, self._request(conn, path, body, content_type)
+            except (OSError, http.client.HTTPException, SolrError) as e:
+                conn.close()
+                conn = None
+                # Client errors (e.g. malformed documents) will not go away by retrying
+                if attempt == self.max_retries or (isinstance(e, SolrError) and e.status < 500):
+                    raise e
+                wait = 2 ** attempt
+                logging.warning(f'Request to {path} failed ({e}), retrying in {wait}s '
+                                f'(attempt {attempt + 1}/{self.max_retries})')
+                time.sleep(wait)
+
+    def _params(self) -> dict:
+        if self.commit_strategy == CommitStrategy.within:
+            return {'commitWithin': self.commit_within}
+        return {}
+
+    def _handler(self, atomic: bool, fmt: DocumentFormat = DocumentFormat.json) -> str:
+        if atomic:
+            path = f'{self.path}/update'
+        elif fmt == DocumentFormat.cbor:
+            path = f'{self.path}/update/cbor'
+        else:
+            path = f'{self.path}/update/json/docs'
+        if self.commit_strategy == CommitStrategy.within:
+            path = f'{path}?{urlencode(self._params())}'
+        return path
+
+    def _work(self):
+        conn = None
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                path, body, content_type = item
+                conn, _ = self._request_retry(conn, path, body, content_type)
+            except Exception as e:
+                conn = None
+                with self._lock:
+                    self.n_failed += 1
+                logging.error(f'Failed to post batch of {len(body):,} bytes to Solr: {e}')
+            finally:
+                self._queue.task_done()
+        if conn is not None:
+            conn.close()
+
+    def _enqueue(self, path: str | None = None):
+        # Queues the pending batch for `path` (or all pending batches)
+        for path in ([path] if path is not None else list(self._batches.keys())):
+            batch = self._batches.pop(path, None)
+            self._batch_lens.pop(path, None)
+            if not batch:
+                continue
+            if path.startswith(f'{self.path}/update/cbor'):
+                self._queue.put((path, cbor.array(batch), 'application/cbor'))
+            else:
+                self._queue.put((path, b'[' + b','.join(batch) + b']', 'application/json'))
+            self.n_batches += 1
+            self._maybe_soft_commit()
+
+    def _maybe_soft_commit(self):
+        if (self.commit_strategy == CommitStrategy.soft
+                and time.time() - self._last_soft_commit > self.soft_commit_interval):
+            self._commit(soft=True)
+
+    def add(self, doc: bytes, atomic: bool = False, fmt: DocumentFormat = DocumentFormat.json):
+        # `doc` is a single encoded JSON document (trailing whitespace is fine) or CBOR map
+        path = self._handler(atomic, fmt)
+        batch = self._batches.setdefault(path, [])
+        batch.append(doc)
+        self._batch_lens[path] = self._batch_lens.get(path, 0) + len(doc)
+        self.n_docs += 1
+        if len(batch) >= self.batch_size or self._batch_lens[path] >= self.batch_bytes:
+            self._enqueue(path)
+
+    def post_file(self, path: Path | str, atomic: bool = False, fmt: DocumentFormat = DocumentFormat.json) -> int:
+        # Posts all documents from a JSON-lines (or CBOR) file and returns the number of documents read
+        n_docs = 0
+        with open(path, 'rb') as f:
+            if fmt == DocumentFormat.cbor:
+                for doc in cbor.read_frames(f):
+                    self.add(doc, fmt=fmt)
+                    n_docs += 1
+            else:
+                for line in f:
+                    if len(line.strip()) > 0:
+                        self.add(line, atomic=atomic)
+                        n_docs += 1
+        return n_docs
+
+    def flush(self):
+        # Wait until all pending documents are posted
+        self._enqueue()
+        self._queue.join()
+        if self.n_failed > 0:
+            raise SolrError(f'{self.n_failed:,} batches failed to post to Solr')
+
+    def update(self, body: bytes, content_type: str = 'application/json', params: dict | None = None) -> bytes:
+        # Synchronous request to the /update handler (e.g. for deletions or commits)
+        path = f'{self.path}/update'
+        params = {**self._params(), **(params or {})}
+        if params:
+            path = f'{path}?{urlencode(params)}'
+        self._conn, response = self._request_retry(self._conn, path, body, content_type)
+        return response
+
+    def delete_ids(self, ids: Iterable[str], batch_size: int = 100000) -> int:
+        # Deletes documents by id (deduplicated) in a few large requests and returns the number of ids
+        self.flush()  # make sure no pending update for one of these ids overtakes the deletion
+        encoder = Encoder()
+        unique_ids = list(dict.fromkeys(i for i in ids if i))
+        for del_batch in batched(unique_ids, batch_size):
+            self.update(encoder.encode({'delete': del_batch}))
+        return len(unique_ids)
+
+    def _commit(self, soft: bool = False):
+        start = time.time()
+        if soft:
+            # Make documents visible without flushing segments, already posted batches are included
+            self.update(b'{"commit": {}}', params={'softCommit': 'true', 'waitSearcher': 'false'})
+            self._last_soft_commit = time.time()
+        else:
+            self.flush()
+            self.update(b'{"commit": {}}')
+        duration = time.time() - start
+        self.n_commits += 1
+        self.commit_time += duration
+        logging.info(f'{"Soft" if soft else "Hard"} commit took {duration:.2f}s '
+                     f'({self.n_commits:,} commits in {self.commit_time:.2f}s so far)')
+
+    def commit(self):
+        # Hard commit of everything posted so far
+        self._commit()
+
+    def partition_done(self):
+        # Called by the updater after all documents of a partition were added
+        if self.commit_strategy == CommitStrategy.partition:
+            self._commit()
+
+    def log_strategy(self):
+        if self.commit_strategy == CommitStrategy.within:
+            logging.info(f'Commit strategy: commitWithin={self.commit_within:,}ms and a final hard commit')
+        elif self.commit_strategy == CommitStrategy.soft:
+            logging.info(f'Commit strategy: soft commit every {self.soft_commit_interval}s and a final hard commit')
+        elif self.commit_strategy == CommitStrategy.partition:
+            logging.info('Commit strategy: hard commit after every partition')
+        else:
+            logging.info('Commit strategy: one hard commit at the end')
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            for _ in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
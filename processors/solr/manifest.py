@@ -0,0 +1,62 @@
+import os
+import json
+import logging
+from enum import Enum
+from pathlib import Path
+
+
+class PartitionState(str, Enum):
+    transformed = 'transformed'  # output files are in `tmp_dir`
+    posted = 'posted'  # all documents were posted, but not necessarily committed
+    committed = 'committed'  # nothing left to do for this partition
+
+
+# Durable record of the progress of an update run, so that a rerun after a failure can skip everything
+# that is already done. Partitions are identified by name and are only considered done if their
+# size and modification time did not change since (e.g. due to a re-sync of the snapshot).
+# Every change is written to disk immediately (atomically via a temporary file).
+class Manifest:
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.partitions: dict[str, dict] = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.partitions = json.load(f)['partitions']
+            logging.info(f'Found progress of a previous run in "{self.path}"')
+
+    @staticmethod
+    def _source(partition: Path) -> dict:
+        stat = partition.stat()
+        return {'source': str(partition), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def get(self, name: str, partition: Path) -> dict | None:
+        # Returns the recorded info (incl. 'state') for this partition, if it still refers to the same file
+        entry = self.partitions.get(name)
+        if entry is None:
+            return None
+        if {k: entry.get(k) for k in ['source', 'size', 'mtime']} != self._source(partition):
+            logging.warning(f'Partition {partition} changed since the previous run, processing it again.')
+            return None
+        return entry
+
+    def mark(self, name: str, partition: Path, state: PartitionState, **info):
+        entry = self.partitions.get(name, {})
+        self.partitions[name] = {**entry, **info, **self._source(partition), 'state': state.value}
+        self.save()
+
+    def mark_all(self, from_state: PartitionState, to_state: PartitionState):
+        for entry in self.partitions.values():
+            if entry['state'] == from_state.value:
+                entry['state'] = to_state.value
+        self.save()
+
+    def save(self):
+        tmp_path = self.path.with_name(f'{self.path.name}.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'partitions': self.partitions}, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        self.path.unlink(missing_ok=True)
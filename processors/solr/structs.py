@@ -1,9 +1,4 @@
-from msgspec import Struct
-
-
-class InvertedAbstract(Struct):
-    IndexLength: int
-    InvertedIndex: dict[str, list[int]]
+from msgspec import Struct, Raw
 
 
 class WorkIds(Struct, omit_defaults=True):
@@ -78,7 +73,7 @@ class LocationOut(Struct, omit_defaults=True, kw_only=True):
 
 
 class Work(Struct, kw_only=True, omit_defaults=True):
-    abstract_inverted_index: dict[str, list[int]] | None = None
+    abstract_inverted_index: Raw = Raw()  # inverted directly from the raw JSON, see `invert_raw`
     authorships: list[Authorship] | None = None
     # apc_list
     # apc_paid
@@ -118,6 +113,12 @@ class Work(Struct, kw_only=True, omit_defaults=True):
     updated_date: str | None = None
 
 
+class WorkRaw(Work, kw_only=True, omit_defaults=True):
+    # Same as `Work`, but nested objects we only pass through are not decoded
+    authorships: list[Raw] | None = None  # only the list itself is decoded, so we can count/cap authorships
+    biblio: Raw = Raw()
+
+
 class WorkOut(Struct, kw_only=True, omit_defaults=True):
     id: str
     display_name: str | None = None
@@ -126,6 +127,8 @@ class WorkOut(Struct, kw_only=True, omit_defaults=True):
     title_abstract: str | None = None
 
     authorships: str | None = None  # list[Authorship]
+    authorships_count: int | None = None
+    authorships_truncated: bool | None = None  # only the first `max_authorships` are in `authorships`
     biblio: str | None = None  # Biblio
     cited_by_count: int | None = None
     created_date: str | None = None
@@ -145,3 +148,20 @@ class WorkOut(Struct, kw_only=True, omit_defaults=True):
     publication_year: int | None = None
     type: str | None = None
     updated_date: str | None = None
+
+
+class SetInt(Struct):
+    set: int | None
+
+
+class SetStr(Struct):
+    set: str | None
+
+
+class WorkCountersOut(Struct, kw_only=True, omit_defaults=True):
+    # Atomic update of the docValues-only fields of an existing document; Solr updates them in-place
+    # without touching (or re-analysing) the rest of the document.
+    id: str
+    cited_by_count: SetInt
+    updated_date: SetStr
+    publication_year: int | None = None  # only for routing to per-period collections, removed before posting
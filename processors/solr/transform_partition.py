@@ -1,30 +1,106 @@
+import os
 import time
 import gzip
 import logging
 import argparse
 from pathlib import Path
+from typing import BinaryIO
 
-from msgspec import DecodeError
+from msgspec import DecodeError, Raw
 from msgspec.json import Decoder, Encoder
 
-from shared.cyth.invert_index import invert
+from shared.cyth.invert_index import invert_raw
 
 from processors.solr.structs import LocationOut
 from shared.util import strip_id
 
-from processors.solr import structs
+from processors.solr import structs, cbor
+from processors.solr.indexer import DocumentFormat
+from processors.solr.fingerprints import FingerprintStore, fingerprint
 
 
-def transform_partition(in_file: str | Path, out_file: str | Path) -> tuple[int, int]:
-    decoder_work = Decoder(structs.Work)
-    decoder_ia = Decoder(structs.InvertedAbstract)
+def raw_json(raw: Raw) -> str | None:
+    # JSON string of a passed-through nested object; missing, null or empty objects are dropped
+    raw = bytes(raw)
+    if raw in {b'', b'null', b'[]', b'{}'}:
+        return None
+    return raw.decode()
+
+
+class BatchWriter:
+    # Appends encoded documents (one per line) to one reusable buffer and writes that in large chunks,
+    # instead of one write per document.
+    def __init__(self, f: BinaryIO, encoder: Encoder, flush_size: int = 4 * 1024 * 1024):
+        self.f = f
+        self.encoder = encoder
+        self.flush_size = flush_size
+        self.buffer = bytearray(flush_size)
+        self.offset = 0
+
+    def write(self, obj):
+        # `encode_into` resizes the buffer to exactly offset + document
+        self.encoder.encode_into(obj, self.buffer, self.offset)
+        self.buffer.append(10)  # newline
+        self.offset = len(self.buffer)
+        if self.offset >= self.flush_size:
+            self.flush()
+
+    def write_bytes(self, data: bytes):
+        self.buffer[self.offset:] = data
+        self.offset = len(self.buffer)
+        if self.offset >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        if self.offset > 0:
+            self.f.write(self.buffer)
+            self.offset = 0  # the next document overwrites the buffer
+
+
+def transform_partition(in_file: str | Path,
+                        out_file: str | Path,
+                        raw_nested: bool = False,
+                        title_abstract: bool = True,
+                        max_authorships: int | None = None,
+                        period_routing: bool = False,
+                        fmt: DocumentFormat = DocumentFormat.json,
+                        fingerprints: str | Path | None = None,
+                        out_fingerprints: str | Path | None = None,
+                        out_partial: str | Path | None = None) -> tuple[int, int]:
+    # With `raw_nested`, authorships and biblio are passed through as they are in the snapshot
+    # instead of being decoded into structs and encoded again.
+    # With `title_abstract`, we concatenate title and abstract here and send it along. Without it, Solr has to fill
+    # `title_abstract` via copyField (see README and `setup/solr_copyfield.json`, needs a full reindex).
+    # With `max_authorships`, only the first N authorships are kept for works with huge author lists
+    # (all authorships are still in postgres, `authorships_count` has the actual number and `authorships_truncated`
+    # flags capped works, both fields are only sent with `max_authorships`).
+    # With `period_routing`, atomic updates include the `publication_year` for the `PeriodIndexer`.
+    # With `fmt=cbor`, documents are written as length-prefixed CBOR maps instead of JSON lines.
+    # With `fingerprints` (path to a `FingerprintStore`), documents that are exactly the same as last time
+    # are dropped and the fingerprints of all other documents are written to `out_fingerprints`.
+    # Documents where only `cited_by_count` and/or `updated_date` changed are written as atomic updates
+    # to `out_partial` (which has to be posted to /update instead of /update/json/docs).
+    decoder_work = Decoder(structs.WorkRaw if raw_nested else structs.Work)
     encoder = Encoder()
+    encoder_cbor = cbor.Encoder()
 
     n_abstracts: int = 0
     n_works: int = 0
+    n_unchanged: int = 0
+    n_partial: int = 0
+    n_truncated: int = 0
     buffer = bytearray(256)
 
-    with gzip.open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+    store = None
+    if fingerprints is not None:
+        store = FingerprintStore(fingerprints, readonly=True)
+
+    with (gzip.open(in_file, 'rb') as f_in,
+          open(out_file, 'wb') as f_out,
+          open(out_fingerprints if store is not None else os.devnull, 'w') as f_fps,
+          open(out_partial if store is not None else os.devnull, 'wb') as f_partial):
+        out = BatchWriter(f_out, encoder)
+        writer_partial = BatchWriter(f_partial, encoder, flush_size=256 * 1024)
         for line in f_in:
             n_works += 1
             try:
@@ -35,29 +111,34 @@ def transform_partition(in_file: str | Path, out_file: str | Path) -> tuple[int,
             wid = strip_id(work.id)
 
             abstract = None
-            if work.abstract_inverted_index is not None:
-                try:
-                    if type(work.abstract_inverted_index) is str:
-                        ia = decoder_ia.decode(work.abstract_inverted_index)
-                        abstract = invert(ia.InvertedIndex, ia.IndexLength)
-                    else:
-                        abstract = invert(work.abstract_inverted_index.InvertedIndex,
-                                          work.abstract_inverted_index.IndexLength)
-                    if len(abstract.strip()) > 0:
-                        n_abstracts += 1
-                    else:
-                        abstract = None
-                except DecodeError:
-                    logging.warning(f'Failed to read abstract for {wid} in {in_file}')
+            try:
+                abstract = invert_raw(work.abstract_inverted_index)
+                if abstract is not None and len(abstract.strip()) > 0:
+                    n_abstracts += 1
+                else:
                     abstract = None
+            except DecodeError:
+                logging.warning(f'Failed to read abstract for {wid} in {in_file}')
+                abstract = None
 
             ta = None
-            if abstract is not None or work.title is not None:
+            if title_abstract and (abstract is not None or work.title is not None):
                 ta = (work.title if work.title is not None else '') + ' ' + (abstract if abstract is not None else '')
 
             authorships = None
+            n_authorships = None
+            truncated = None
             if work.authorships is not None and len(work.authorships) > 0:
-                authorships = encoder.encode(work.authorships).decode()
+                n_authorships = len(work.authorships)
+                authorships_capped = work.authorships
+                if max_authorships is not None and n_authorships > max_authorships:
+                    authorships_capped = work.authorships[:max_authorships]
+                    truncated = True
+                    n_truncated += 1
+                if raw_nested:
+                    authorships = (b'[' + b','.join(authorships_capped) + b']').decode()
+                else:
+                    authorships = encoder.encode(authorships_capped).decode()
 
             locations = None
             if work.locations is not None and len(work.locations) > 0:
@@ -80,7 +161,9 @@ def transform_partition(in_file: str | Path, out_file: str | Path) -> tuple[int,
                     for loc in work.locations]).decode()
 
             biblio = None
-            if work.biblio is not None and work.biblio.volume is not None:
+            if raw_nested:
+                biblio = raw_json(work.biblio)
+            elif work.biblio is not None and work.biblio.volume is not None:
                 biblio = encoder.encode(work.biblio).decode()
 
             mag = None
@@ -97,8 +180,9 @@ def transform_partition(in_file: str | Path, out_file: str | Path) -> tuple[int,
                                  abstract=abstract,
                                  title_abstract=ta,
                                  authorships=authorships,
+                                 authorships_count=n_authorships if max_authorships is not None else None,
+                                 authorships_truncated=truncated,
                                  biblio=biblio,
-                                 cited_by_count=work.cited_by_count,
                                  created_date=work.created_date,
                                  doi=work.doi,
                                  mag=mag,
@@ -111,16 +195,55 @@ def transform_partition(in_file: str | Path, out_file: str | Path) -> tuple[int,
                                  locations=locations,
                                  publication_date=work.publication_date,
                                  publication_year=work.publication_year,
-                                 type=work.type,
-                                 updated_date=work.updated_date)
+                                 type=work.type)
+
+            if store is not None:
+                # The content fingerprint excludes the counters, which are added to the full fingerprint.
+                # This way, we only need to encode the document once for unchanged works.
+                encoder.encode_into(wo, buffer)
+                content_fp = fingerprint(buffer)
+                fp = fingerprint(content_fp + encoder.encode((work.cited_by_count, work.updated_date)))
+                previous = store.get(wid)
+                if previous is not None and previous[0] == fp:
+                    n_unchanged += 1
+                    continue
+                f_fps.write(f'{wid}\t{fp.hex()}\t{content_fp.hex()}\n')
+
+                if previous is not None and previous[1] == content_fp:
+                    n_partial += 1
+                    writer_partial.write(structs.WorkCountersOut(id=wid,
+                                                                 cited_by_count=structs.SetInt(work.cited_by_count),
+                                                                 updated_date=structs.SetStr(work.updated_date),
+                                                                 publication_year=(work.publication_year
+                                                                                   if period_routing else None)))
+                    continue
+
+            wo.cited_by_count = work.cited_by_count
+            wo.updated_date = work.updated_date
+            if fmt == DocumentFormat.cbor:
+                out.write_bytes(cbor.frame(encoder_cbor.encode(wo)))
+            else:
+                out.write(wo)
 
-            encoder.encode_into(wo, buffer)
-            buffer.extend(b'\n')
-            f_out.write(buffer)
+        out.flush()
+        writer_partial.flush()
+
+    if n_truncated > 0:
+        logging.info(f'Truncated authorships of {n_truncated:,} works to {max_authorships:,} ({in_file})')
+
+    if store is not None:
+        store.close()
+        logging.info(f'Dropped {n_unchanged:,} of {n_works:,} works that did not change since last time '
+                     f'and {n_partial:,} only need an update of their counters ({in_file})')
 
     return n_works, n_abstracts
 
 
+def transform_partition_kw(kwargs) -> tuple[dict, int, int]:
+    n_works, n_abstracts = transform_partition(**kwargs)
+    return kwargs, n_works, n_abstracts
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='PartitionTransformer',
                                      description='Transform OpenAlex partition into our solr format')
@@ -128,6 +251,14 @@ if __name__ == '__main__':
     parser.add_argument('infile')
     parser.add_argument('outfile')
     parser.add_argument('-q', '--quiet', action='store_false', dest='log')
+    parser.add_argument('--raw-nested', action='store_true', dest='raw_nested',
+                        help='Pass through nested objects without decoding them')
+    parser.add_argument('--solr-copyfield', action='store_false', dest='title_abstract',
+                        help='Leave title_abstract to the copyField in the Solr schema (setup/solr_copyfield.json)')
+    parser.add_argument('--max-authorships', type=int, default=None, dest='max_authorships',
+                        help='Only keep the first N authorships of every work')
+    parser.add_argument('--format', choices=[f.value for f in DocumentFormat], default='json', dest='fmt',
+                        help='Output format (run with both to compare speed and size)')
 
     args = parser.parse_args()
 
@@ -137,7 +268,11 @@ if __name__ == '__main__':
     startTime = time.time()
     logging.info(f'Processing partition file "{args.infile}" and writing to "{args.outfile}"')
 
-    n_works, n_abstracts = transform_partition(args.infile, args.outfile)
+    n_works, n_abstracts = transform_partition(args.infile, args.outfile, raw_nested=args.raw_nested,
+                                               title_abstract=args.title_abstract,
+                                               max_authorships=args.max_authorships,
+                                               fmt=DocumentFormat(args.fmt))
 
     executionTime = (time.time() - startTime)
     logging.info(f'Found {n_abstracts:,} abstracts in {n_works:,} works in {executionTime}s')
+    logging.info(f'Wrote {Path(args.outfile).stat().st_size:,} bytes as {args.fmt}')
@@ -14,8 +14,9 @@ class Settings(BaseSettings):
     solr_host: str = 'localhost'  # solr host
     solr_port: int = 8983
     solr_collection: str = 'openalex'  # Solr collection
-    solr_bin: Path  # Path to solr bin directory
+    solr_bin: Path | None = None  # Path to solr bin directory (not needed for updates, we post via HTTP)
     solr_url: str | None = None
+    solr_configset: str = 'openalex'  # Solr configset used to create new (per-period) collections
 
     pg_scheme: str = 'postgresql'
     pg_host: str = 'localhost'  # host of the db server
@@ -40,7 +41,7 @@ class Settings(BaseSettings):
             password=info.data.get('pg_pw'),
             host=info.data.get('pg_host'),
             port=info.data.get('pg_port'),
-            path=f'/{info.data.get("pg_db", "")}',
+            path=info.data.get('pg_db', ''),
         )
 
     @field_validator('last_update', mode='before')
@@ -1,3 +1,12 @@
+# cython: boundscheck=False, wraparound=False, initializedcheck=False
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memcpy, memset
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+
+from msgspec import DecodeError
+from msgspec.json import decode
+
+
 def invert(dict[str, list[int]] inverted_index) -> str:
     cdef str token
     cdef int position
@@ -12,3 +21,249 @@ def invert(dict[str, list[int]] inverted_index) -> str:
                 abstract[position] = token
 
     return ' '.join(abstract)
+
+
+cdef inline bint is_ws(unsigned char c) noexcept nogil:
+    return c == 32 or c == 10 or c == 13 or c == 9
+
+
+cdef class _Inverter:
+    # Collects (position, token) pairs while scanning the raw JSON of an inverted index.
+    # Tokens are referenced by their offset and length, either in the input or (if they
+    # contained escape sequences) in the `unescaped` buffer.
+    cdef const unsigned char[:] buf
+    cdef Py_ssize_t n
+    cdef Py_ssize_t index_length
+
+    cdef Py_ssize_t n_tokens, cap_tokens
+    cdef Py_ssize_t* tok_start
+    cdef Py_ssize_t* tok_len
+    cdef bint* tok_unescaped
+    cdef bytearray unescaped
+
+    cdef Py_ssize_t n_pairs, cap_pairs
+    cdef Py_ssize_t* pair_pos
+    cdef Py_ssize_t* pair_tok
+
+    def __cinit__(self, const unsigned char[:] buf):
+        self.buf = buf
+        self.n = buf.shape[0]
+        self.index_length = 0
+        self.n_tokens = 0
+        self.cap_tokens = 64
+        self.tok_start = <Py_ssize_t*> malloc(self.cap_tokens * sizeof(Py_ssize_t))
+        self.tok_len = <Py_ssize_t*> malloc(self.cap_tokens * sizeof(Py_ssize_t))
+        self.tok_unescaped = <bint*> malloc(self.cap_tokens * sizeof(bint))
+        self.unescaped = bytearray()
+        self.n_pairs = 0
+        self.cap_pairs = 256
+        self.pair_pos = <Py_ssize_t*> malloc(self.cap_pairs * sizeof(Py_ssize_t))
+        self.pair_tok = <Py_ssize_t*> malloc(self.cap_pairs * sizeof(Py_ssize_t))
+        if (self.tok_start == NULL or self.tok_len == NULL or self.tok_unescaped == NULL
+                or self.pair_pos == NULL or self.pair_tok == NULL):
+            raise MemoryError()
+
+    def __dealloc__(self):
+        free(self.tok_start)
+        free(self.tok_len)
+        free(self.tok_unescaped)
+        free(self.pair_pos)
+        free(self.pair_tok)
+
+    cdef Py_ssize_t skip_ws(self, Py_ssize_t i):
+        while i < self.n and is_ws(self.buf[i]):
+            i += 1
+        return i
+
+    cdef Py_ssize_t expect(self, Py_ssize_t i, unsigned char c) except -1:
+        i = self.skip_ws(i)
+        if i >= self.n or self.buf[i] != c:
+            raise DecodeError(f'Malformed inverted index, expected "{chr(c)}" at {i}')
+        return i + 1
+
+    cdef Py_ssize_t string_end(self, Py_ssize_t i, bint* escaped) except -1:
+        # `i` points behind the opening quote, returns the index of the closing quote
+        while i < self.n:
+            if self.buf[i] == 92:  # backslash
+                escaped[0] = True
+                i += 2
+            elif self.buf[i] == 34:  # quote
+                return i
+            else:
+                i += 1
+        raise DecodeError('Malformed inverted index, unterminated string')
+
+    cdef int add_token(self, Py_ssize_t start, Py_ssize_t end, bint escaped) except -1:
+        cdef bytes token
+        if self.n_tokens == self.cap_tokens:
+            self.cap_tokens *= 2
+            self.tok_start = <Py_ssize_t*> realloc(self.tok_start, self.cap_tokens * sizeof(Py_ssize_t))
+            self.tok_len = <Py_ssize_t*> realloc(self.tok_len, self.cap_tokens * sizeof(Py_ssize_t))
+            self.tok_unescaped = <bint*> realloc(self.tok_unescaped, self.cap_tokens * sizeof(bint))
+            if self.tok_start == NULL or self.tok_len == NULL or self.tok_unescaped == NULL:
+                raise MemoryError()
+        if escaped:
+            # Rare case, let msgspec deal with escape sequences
+            token = decode(bytes(self.buf[start - 1:end + 1]), type=str).encode()
+            self.tok_start[self.n_tokens] = len(self.unescaped)
+            self.tok_len[self.n_tokens] = len(token)
+            self.tok_unescaped[self.n_tokens] = True
+            self.unescaped.extend(token)
+        else:
+            self.tok_start[self.n_tokens] = start
+            self.tok_len[self.n_tokens] = end - start
+            self.tok_unescaped[self.n_tokens] = False
+        self.n_tokens += 1
+        return 0
+
+    cdef int add_pair(self, Py_ssize_t position) except -1:
+        if self.n_pairs == self.cap_pairs:
+            self.cap_pairs *= 2
+            self.pair_pos = <Py_ssize_t*> realloc(self.pair_pos, self.cap_pairs * sizeof(Py_ssize_t))
+            self.pair_tok = <Py_ssize_t*> realloc(self.pair_tok, self.cap_pairs * sizeof(Py_ssize_t))
+            if self.pair_pos == NULL or self.pair_tok == NULL:
+                raise MemoryError()
+        self.pair_pos[self.n_pairs] = position
+        self.pair_tok[self.n_pairs] = self.n_tokens - 1
+        self.n_pairs += 1
+        return 0
+
+    cdef Py_ssize_t parse_int(self, Py_ssize_t i, Py_ssize_t* value) except -1:
+        cdef Py_ssize_t v = 0
+        cdef Py_ssize_t start = i
+        while i < self.n and 48 <= self.buf[i] <= 57:
+            if v <= self.n:  # anything larger is beyond the abstract anyway, so it stays there (without overflowing)
+                v = v * 10 + (self.buf[i] - 48)
+            i += 1
+        if i == start:
+            raise DecodeError(f'Malformed inverted index, expected a number at {i}')
+        value[0] = v
+        return i
+
+    cdef Py_ssize_t parse_positions(self, Py_ssize_t i) except -1:
+        # `i` points behind the opening bracket of a list of positions
+        cdef Py_ssize_t position
+        i = self.skip_ws(i)
+        if i < self.n and self.buf[i] == 93:  # empty list
+            return i + 1
+        while True:
+            i = self.parse_int(self.skip_ws(i), &position)
+            self.add_pair(position)
+            i = self.skip_ws(i)
+            if i < self.n and self.buf[i] == 44:  # comma
+                i += 1
+            elif i < self.n and self.buf[i] == 93:  # closing bracket
+                return i + 1
+            else:
+                raise DecodeError(f'Malformed inverted index, unexpected character at {i}')
+
+    cdef Py_ssize_t parse_object(self, Py_ssize_t i, bint top) except -1:
+        # Parses {"token": [positions], ...}. On the top level, this may also be the legacy
+        # {"IndexLength": int, "InvertedIndex": {"token": [positions], ...}} format.
+        cdef Py_ssize_t start, end, value
+        cdef bint escaped
+        i = self.expect(i, 123)  # opening brace
+        i = self.skip_ws(i)
+        if i < self.n and self.buf[i] == 125:  # empty object
+            return i + 1
+        while True:
+            i = self.expect(i, 34)
+            escaped = False
+            start = i
+            end = self.string_end(i, &escaped)
+            i = self.skip_ws(self.expect(end + 1, 58))  # colon
+            if i >= self.n:
+                raise DecodeError('Malformed inverted index, unexpected end')
+
+            if self.buf[i] == 91:  # opening bracket
+                self.add_token(start, end, escaped)
+                i = self.parse_positions(i + 1)
+            elif top and self.buf[i] == 123 and bytes(self.buf[start:end]) == b'InvertedIndex':
+                i = self.parse_object(i, False)
+            elif top and 48 <= self.buf[i] <= 57 and bytes(self.buf[start:end]) == b'IndexLength':
+                i = self.parse_int(i, &value)
+                if self.index_length <= 0:
+                    self.index_length = value
+            else:
+                raise DecodeError(f'Malformed inverted index, unexpected value at {i}')
+
+            i = self.skip_ws(i)
+            if i < self.n and self.buf[i] == 44:  # comma
+                i += 1
+            elif i < self.n and self.buf[i] == 125:  # closing brace
+                return i + 1
+            else:
+                raise DecodeError(f'Malformed inverted index, unexpected character at {i}')
+
+    cdef str assemble(self):
+        # Same as `invert`: one word per position in the index (at most "IndexLength"), positions beyond that are
+        # dropped and missing positions stay empty (so gaps or duplicates leave extra spaces behind).
+        # That also bounds the buffer by the size of the input, whatever positions or lengths it claims.
+        cdef Py_ssize_t length = self.n_pairs
+        cdef Py_ssize_t pi, si, tok, total
+        cdef Py_ssize_t* slots
+        cdef char* out
+        cdef const unsigned char* src
+        cdef const unsigned char* pool
+        cdef bytes result
+
+        if 0 < self.index_length < length:
+            length = self.index_length
+        if length <= 0:
+            return ''
+
+        slots = <Py_ssize_t*> malloc(length * sizeof(Py_ssize_t))
+        if slots == NULL:
+            raise MemoryError()
+        try:
+            memset(slots, 0xff, length * sizeof(Py_ssize_t))  # all -1
+            for pi in range(self.n_pairs):
+                if self.pair_pos[pi] < length:
+                    slots[self.pair_pos[pi]] = self.pair_tok[pi]
+
+            total = length - 1  # separating spaces
+            for si in range(length):
+                if slots[si] >= 0:
+                    total += self.tok_len[slots[si]]
+
+            result = PyBytes_FromStringAndSize(NULL, total)
+            out = PyBytes_AS_STRING(result)
+            src = &self.buf[0]
+            pool = <const unsigned char*> (<char*> self.unescaped) if len(self.unescaped) > 0 else NULL
+            for si in range(length):
+                if si > 0:
+                    out[0] = 32
+                    out += 1
+                tok = slots[si]
+                if tok >= 0:
+                    if self.tok_unescaped[tok]:
+                        memcpy(out, pool + self.tok_start[tok], self.tok_len[tok])
+                    else:
+                        memcpy(out, src + self.tok_start[tok], self.tok_len[tok])
+                    out += self.tok_len[tok]
+        finally:
+            free(slots)
+
+        return result.decode('utf-8')
+
+
+def invert_raw(raw, Py_ssize_t index_length=0) -> str | None:
+    # Rebuilds the abstract directly from the raw JSON bytes (e.g. msgspec.Raw) of an `abstract_inverted_index`.
+    # Also accepts the legacy format {"IndexLength": .., "InvertedIndex": {..}}, optionally wrapped in a JSON string.
+    # The abstract has one word per position in the index (like `invert`), or `index_length` (or "IndexLength") if fewer.
+    cdef const unsigned char[:] buf = raw
+    cdef _Inverter inverter
+    cdef Py_ssize_t i = 0
+    cdef Py_ssize_t n = buf.shape[0]
+
+    while i < n and is_ws(buf[i]):
+        i += 1
+    if i >= n or buf[i] == 110:  # missing or null
+        return None
+    if buf[i] == 34:  # abstract index encoded as a string
+        return invert_raw(decode(bytes(raw), type=str).encode(), index_length)
+
+    inverter = _Inverter(buf)
+    inverter.index_length = index_length
+    inverter.parse_object(i, True)
+    return inverter.assemble()
@@ -0,0 +1,55 @@
+# cython: boundscheck=False, wraparound=False, initializedcheck=False
+from libc.stdint cimport uint32_t, int32_t
+
+
+cdef inline uint32_t rotl32(uint32_t x, int r) noexcept nogil:
+    return (x << r) | (x >> (32 - r))
+
+
+def murmurhash3_x86_32(const unsigned char[:] data, uint32_t seed=0):
+    # MurmurHash3 (x86, 32bit) as used by Solr's CompositeIdRouter, returns a signed 32bit int like Java does
+    cdef Py_ssize_t n = data.shape[0]
+    cdef Py_ssize_t nblocks = n // 4
+    cdef Py_ssize_t i, tail
+    cdef uint32_t c1 = 0xcc9e2d51
+    cdef uint32_t c2 = 0x1b873593
+    cdef uint32_t c3 = 0xe6546b64
+    cdef uint32_t f1 = 0x85ebca6b
+    cdef uint32_t f2 = 0xc2b2ae35
+    cdef uint32_t h1 = seed
+    cdef uint32_t k1
+    cdef int32_t result
+
+    for i in range(nblocks):
+        k1 = (<uint32_t> data[4 * i]
+              | (<uint32_t> data[4 * i + 1] << 8)
+              | (<uint32_t> data[4 * i + 2] << 16)
+              | (<uint32_t> data[4 * i + 3] << 24))
+        k1 *= c1
+        k1 = rotl32(k1, 15)
+        k1 *= c2
+        h1 ^= k1
+        h1 = rotl32(h1, 13)
+        h1 = h1 * 5 + c3
+
+    tail = nblocks * 4
+    k1 = 0
+    if n & 3 == 3:
+        k1 ^= <uint32_t> data[tail + 2] << 16
+    if n & 3 >= 2:
+        k1 ^= <uint32_t> data[tail + 1] << 8
+    if n & 3 >= 1:
+        k1 ^= <uint32_t> data[tail]
+        k1 *= c1
+        k1 = rotl32(k1, 15)
+        k1 *= c2
+        h1 ^= k1
+
+    h1 ^= <uint32_t> n
+    h1 ^= h1 >> 16
+    h1 *= f1
+    h1 ^= h1 >> 13
+    h1 *= f2
+    h1 ^= h1 >> 16
+    result = <int32_t> h1
+    return result
@@ -3,7 +3,7 @@ from Cython.Build import cythonize
 
 setup(
     ext_modules=cythonize(
-        'invert_index.pyx',
+        ['invert_index.pyx', 'murmur.pyx'],
         language_level='3',
         annotate=False
     ),
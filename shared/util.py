@@ -19,7 +19,7 @@ def get_globs(snapshot: Path,  # /path/to/openalex-snapshot
 def get_ids_to_delete(merge_files: list[Path]) -> Generator[str, None, None]:
     import csv
     for file in merge_files:
-        with gzip.open(file, 'r', newline='') as csvfile:
+        with gzip.open(file, 'rt', newline='') as csvfile:
             reader = csv.reader(csvfile, delimiter=',')
             next(reader)  # skip header: merge_date,id,merge_into_id
             yield from [
@@ -37,14 +37,26 @@ def strip_id(s: str | None) -> str | None:
     return None
 
 
+def picklify(params):
+    return [
+        {
+            # Path cannot be pickled, so stringify them
+            k: (str(v) if isinstance(v, Path) else v)
+            for k, v in p.items()
+        }
+        for p in params
+    ]
+
+
 def batched(it: Iterable[str], bs: int) -> Generator[list[str], None, None]:
     batch = []
     cnt = 0
     for i in it:
         batch.append(i)
         cnt += 1
-        if cnt > bs:
+        if cnt >= bs:
             yield batch
             batch = []
             cnt = 0
-    yield batch
+    if len(batch) > 0:
+        yield batch
@@ -0,0 +1,56 @@
+import sqlite3
+import tempfile
+import unittest
+from pathlib import Path
+
+from processors.solr.fingerprints import FingerprintStore, fingerprint
+
+
+class FingerprintStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'fp' / 'fingerprints.sqlite'
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_fingerprint(self):
+        self.assertEqual(len(fingerprint(b'{"id":"W1"}')), 16)
+        self.assertEqual(fingerprint(b'{"id":"W1"}'), fingerprint(bytearray(b'{"id":"W1"}')))
+        self.assertNotEqual(fingerprint(b'{"id":"W1"}'), fingerprint(b'{"id":"W2"}'))
+
+    def test_update_get_delete(self):
+        with FingerprintStore(self.path) as store:
+            self.assertIsNone(store.get('W1'))
+            store.update([('W1', b'a', b'b'), ('W2', b'c', b'd')])
+            store.update([('W1', b'e', b'f')])  # replaced
+            self.assertEqual(store.get('W1'), (b'e', b'f'))
+            store.delete(['W2', 'W3'])
+            self.assertIsNone(store.get('W2'))
+
+        # Transformers only read
+        with FingerprintStore(self.path, readonly=True) as store:
+            self.assertEqual(store.get('W1'), (b'e', b'f'))
+            with self.assertRaises(sqlite3.OperationalError):
+                store.update([('W4', b'g', b'h')])
+
+    def test_update_from_file(self):
+        fp_file = Path(self.tmp.name) / 'solr-part_000.fp'
+        fp_file.write_text('W1\t0a0b\t0c\nW2\tff\t00\n')
+        with FingerprintStore(self.path) as store:
+            self.assertEqual(store.update_from_file(fp_file), 2)
+            self.assertEqual(store.get('W1'), (b'\x0a\x0b', b'\x0c'))
+            self.assertEqual(store.get('W2'), (b'\xff', b'\x00'))
+
+    def test_old_store(self):
+        # Stores from before we tracked content fingerprints get the column
+        self.path.parent.mkdir(parents=True)
+        with sqlite3.connect(self.path) as conn:
+            conn.execute('CREATE TABLE fingerprints (id TEXT PRIMARY KEY, fingerprint BLOB NOT NULL) WITHOUT ROWID')
+            conn.execute("INSERT INTO fingerprints VALUES ('W1', x'01')")
+        with FingerprintStore(self.path) as store:
+            self.assertEqual(store.get('W1'), (b'\x01', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import random
+import unittest
+
+from msgspec import DecodeError
+from msgspec.json import decode, encode
+
+from shared.cyth.invert_index import invert, invert_raw
+
+
+class InvertRawTest(unittest.TestCase):
+    def assertSameAsInvert(self, index: dict[str, list[int]]):
+        raw = encode(index)
+        self.assertEqual(invert_raw(raw), invert(decode(raw, type=dict[str, list[int]])))
+
+    def test_abstract(self):
+        self.assertEqual(invert_raw(b'{"Hello": [0], "world": [1, 3], "again": [2]}'), 'Hello world again world')
+
+    def test_missing(self):
+        self.assertIsNone(invert_raw(b'null'))
+        self.assertIsNone(invert_raw(b''))
+        self.assertEqual(invert_raw(b'{}'), '')
+
+    def test_escaped(self):
+        self.assertEqual(invert_raw(b'{"caf\\u00e9": [1], "\\"quoted\\"": [0]}'), '"quoted" café')
+
+    def test_legacy(self):
+        legacy = b'{"IndexLength": 2, "InvertedIndex": {"a": [0], "b": [1], "c": [2]}}'
+        self.assertEqual(invert_raw(legacy), 'a b')
+        self.assertEqual(invert_raw(encode(legacy.decode())), 'a b')
+
+    def test_gaps_like_invert(self):
+        # One word per position in the index, positions beyond are dropped, missing ones stay empty
+        self.assertEqual(invert_raw(b'{"a": [0], "b": [5]}'), 'a ')
+        self.assertEqual(invert_raw(b'{"a": [0, 1], "b": [1]}'), 'a b ')
+        self.assertSameAsInvert({'a': [0], 'b': [5]})
+        self.assertSameAsInvert({'a': [0, 1], 'b': [1]})
+
+    def test_random_like_invert(self):
+        rng = random.Random(42)
+        for _ in range(200):
+            n = rng.randint(0, 50)
+            index: dict[str, list[int]] = {}
+            for position in rng.sample(range(n + 10), n):
+                index.setdefault(f'w{rng.randint(0, 20)}', []).append(position)
+            self.assertSameAsInvert(index)
+
+    def test_huge_positions(self):
+        # Neither allocates for the claimed position/length nor overflows
+        self.assertEqual(invert_raw(b'{"a":[99999999999999]}'), '')
+        self.assertEqual(invert_raw(b'{"a":[0],"b":[99999999999999999999999999999999]}'), 'a ')
+        self.assertEqual(invert_raw(b'{"IndexLength": 99999999999999, "InvertedIndex": {"a": [0]}}'), 'a')
+
+    def test_malformed(self):
+        for raw in [b'{"a": [0', b'{"a": [-1]}', b'{"a": 1}', b'{"a" [0]}', b'[1, 2]', b'{"a": [0]']:
+            with self.assertRaises(DecodeError):
+                invert_raw(raw)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+# Settings are read on import, nothing here connects to the database
+os.environ.setdefault('OA_SNAPSHOT', '/tmp/openalex-snapshot')
+os.environ.setdefault('OA_LAST_UPDATE_FILE', '/tmp/openalex-last-update')
+os.environ.setdefault('OA_PG_PW', '')
+
+from processors.postgres.load import iter_statements, read_script  # noqa: E402
+from shared.config import settings  # noqa: E402
+
+SCHEMA = settings.pg_schema
+
+SCRIPT = f'''BEGIN;
+CREATE TEMPORARY TABLE ids_to_delete (id text) ON COMMIT DROP;
+COPY ids_to_delete (id) FROM STDIN;
+W1
+W2;
+\\.
+DELETE FROM {SCHEMA}.works t
+  USING ids_to_delete d
+  WHERE t.id = d.id;
+COPY {SCHEMA}.works_concepts (work_id, concept_id, score) FROM PROGRAM 'gzip -dc /tmp/con.csv.gz' csv header;
+INSERT INTO {SCHEMA}.publishers (id) SELECT id FROM staging_publishers ON CONFLICT (id) DO UPDATE SET id = EXCLUDED.id;
+COPY {SCHEMA}.works (id) FROM STDIN;
+\\.
+COMMIT;
+'''
+
+
+class LoadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = Path(self.tmp.name) / 'pg-work-part_000-del.sql'
+        self.path.write_text(SCRIPT)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_iter_statements(self):
+        statements = [(statement, None if data is None else list(data))
+                      for statement, data in iter_statements(self.path)]
+        self.assertEqual([statement for statement, _ in statements], [
+            'BEGIN',
+            'CREATE TEMPORARY TABLE ids_to_delete (id text) ON COMMIT DROP',
+            'COPY ids_to_delete (id) FROM STDIN',
+            f'DELETE FROM {SCHEMA}.works t\n  USING ids_to_delete d\n  WHERE t.id = d.id',
+            f"COPY {SCHEMA}.works_concepts (work_id, concept_id, score) FROM PROGRAM 'gzip -dc /tmp/con.csv.gz' "
+            f"csv header",
+            f'INSERT INTO {SCHEMA}.publishers (id) SELECT id FROM staging_publishers '
+            f'ON CONFLICT (id) DO UPDATE SET id = EXCLUDED.id',
+            f'COPY {SCHEMA}.works (id) FROM STDIN',
+            'COMMIT',
+        ])
+        # Inline data up to "\." (a line ending with ";" is data, not the end of a statement)
+        self.assertEqual(statements[2][1], ['W1\n', 'W2;\n'])
+        self.assertEqual(statements[6][1], [])
+        self.assertTrue(all(data is None for si, (_, data) in enumerate(statements) if si not in {2, 6}))
+
+    def test_iter_statements_skips_unread_data(self):
+        statements = [statement for statement, _ in iter_statements(self.path)]  # data is never consumed
+        self.assertEqual(len(statements), 8)
+        self.assertEqual(statements[3][:11], 'DELETE FROM')
+
+    def test_read_script(self):
+        script = read_script(self.path)
+        self.assertEqual(script.path, self.path)
+        # Temporary tables don't count, upserts count as deleting and inserting
+        self.assertEqual(script.deletes, {f'{SCHEMA}.works', f'{SCHEMA}.publishers'})
+        self.assertEqual(script.inserts, {f'{SCHEMA}.works_concepts', f'{SCHEMA}.publishers', f'{SCHEMA}.works'})
+        self.assertEqual(script.written, script.deletes | script.inserts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+from processors.solr.manifest import Manifest, PartitionState
+
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.path = self.dir / 'solr-manifest.json'
+        self.partitions = []
+        for pi in range(3):
+            partition = self.dir / f'part_{pi:03d}.gz'
+            partition.write_bytes(b'x' * (pi + 1))
+            self.partitions.append(partition)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def state(self, manifest: Manifest, pi: int) -> str | None:
+        entry = manifest.get(f'part_{pi}', self.partitions[pi])
+        return None if entry is None else entry['state']
+
+    def test_new(self):
+        manifest = Manifest(self.path)
+        self.assertIsNone(self.state(manifest, 0))
+        self.assertFalse(self.path.exists())
+
+    def test_transitions(self):
+        manifest = Manifest(self.path)
+        manifest.mark('part_0', self.partitions[0], PartitionState.transformed, n_docs=10)
+        manifest.mark('part_1', self.partitions[1], PartitionState.transformed, n_docs=20)
+        manifest.mark('part_0', self.partitions[0], PartitionState.posted)
+        self.assertEqual(self.state(manifest, 0), 'posted')
+        self.assertEqual(self.state(manifest, 1), 'transformed')
+        self.assertEqual(manifest.get('part_0', self.partitions[0])['n_docs'], 10)  # info is kept
+
+        manifest.mark_all(PartitionState.posted, PartitionState.committed)
+        self.assertEqual(self.state(manifest, 0), 'committed')
+        self.assertEqual(self.state(manifest, 1), 'transformed')
+
+    def test_rerun(self):
+        # Every change is on disk right away, a new run picks it up
+        Manifest(self.path).mark('part_2', self.partitions[2], PartitionState.posted)
+        manifest = Manifest(self.path)
+        self.assertEqual(self.state(manifest, 2), 'posted')
+        self.assertFalse(self.path.with_name(f'{self.path.name}.tmp').exists())
+
+        manifest.remove()
+        self.assertFalse(self.path.exists())
+        self.assertIsNone(self.state(Manifest(self.path), 2))
+
+    def test_changed_partition(self):
+        manifest = Manifest(self.path)
+        manifest.mark('part_0', self.partitions[0], PartitionState.posted)
+        self.partitions[0].write_bytes(b'changed')
+        self.assertIsNone(self.state(manifest, 0))
+
+        manifest.mark('part_1', self.partitions[1], PartitionState.posted)
+        stat = self.partitions[1].stat()
+        os.utime(self.partitions[1], (stat.st_atime, stat.st_mtime + 10))
+        self.assertIsNone(self.state(manifest, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
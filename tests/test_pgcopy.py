@@ -0,0 +1,77 @@
+import io
+import struct
+import unittest
+from datetime import datetime
+
+from processors.postgres.pgcopy import array_literal, parse_schema, get_encoders, BinaryWriter, ENCODERS, \
+    HEADER, TRAILER
+
+
+def read_text_array(b: bytes) -> list[str]:
+    # Inverse of the binary text[] encoding (length prefix included)
+    length, n_dims, has_null, oid = struct.unpack('>iiii', b[:16])
+    assert length == len(b) - 4 and has_null == 0 and oid == 25
+    if n_dims == 0:
+        return []
+    n_items, lower = struct.unpack('>ii', b[16:24])
+    assert n_dims == 1 and lower == 1
+    items = []
+    pos = 24
+    for _ in range(n_items):
+        (item_length,) = struct.unpack('>i', b[pos:pos + 4])
+        items.append(b[pos + 4:pos + 4 + item_length].decode())
+        pos += 4 + item_length
+    assert pos == len(b)
+    return items
+
+
+class PgCopyTest(unittest.TestCase):
+    values = ['plain', 'a,b', 'say "hi"', 'back\\slash', "it's", '{brace}', 'NULL', '', 'ü']
+
+    def test_schema_has_encoders(self):
+        tables = parse_schema()
+        self.assertIn('works', tables)
+        self.assertEqual(tables['institutions']['display_name_alternatives'], 'text[]')
+        for table, columns in tables.items():
+            self.assertEqual(len(get_encoders(table, list(columns.keys()))), len(columns))
+
+    def test_array_literal(self):
+        self.assertEqual(array_literal([]), '{}')
+        self.assertEqual(array_literal(['a', 'b']), '{"a","b"}')
+        self.assertEqual(array_literal(['a,b', 'say "hi"', 'back\\slash']), '{"a,b","say \\"hi\\"","back\\\\slash"}')
+
+    def test_text_array_lossless(self):
+        self.assertEqual(read_text_array(ENCODERS['text[]'](self.values)), self.values)
+        self.assertEqual(read_text_array(ENCODERS['text[]']([])), [])
+
+    def test_text_of_list(self):
+        # Lists in text columns get the same literal as in csv files
+        self.assertEqual(ENCODERS['text'](['a,b', 'c']), struct.pack('>i', 11) + b'{"a,b","c"}')
+
+    def test_scalars(self):
+        self.assertEqual(ENCODERS['integer'](42), struct.pack('>ii', 4, 42))
+        self.assertEqual(ENCODERS['bigint']('12345678901'), struct.pack('>iq', 8, 12345678901))
+        self.assertEqual(ENCODERS['real'](0.5), struct.pack('>if', 4, 0.5))
+        self.assertEqual(ENCODERS['boolean'](True), struct.pack('>ib', 1, 1))
+        self.assertEqual(ENCODERS['boolean'](False), struct.pack('>ib', 1, 0))
+        timestamp = ENCODERS['timestamp without time zone']
+        self.assertEqual(timestamp('2000-01-01'), struct.pack('>iq', 8, 0))
+        self.assertEqual(timestamp('2000-01-02T00:00:01.5'), struct.pack('>iq', 8, 86_401_500_000))
+        self.assertEqual(timestamp(datetime(1999, 12, 31)), struct.pack('>iq', 8, -86_400_000_000))
+
+    def test_writer(self):
+        f = io.BytesIO()
+        writer = BinaryWriter(f, 'institutions', ['id', 'display_name_alternatives', 'works_count'])
+        writer.writeheader()
+        writer.writerow(('I1', ['a,b'], None))
+        writer.writetrailer()
+        self.assertEqual(f.getvalue(),
+                         HEADER + struct.pack('>h', 3)
+                         + struct.pack('>i', 2) + b'I1'
+                         + ENCODERS['text[]'](['a,b'])
+                         + struct.pack('>i', -1)
+                         + TRAILER)
+
+
+if __name__ == '__main__':
+    unittest.main()
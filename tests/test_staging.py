@@ -0,0 +1,40 @@
+import os
+import unittest
+
+# Settings are read on import, nothing here connects to the database
+os.environ.setdefault('OA_SNAPSHOT', '/tmp/openalex-snapshot')
+os.environ.setdefault('OA_LAST_UPDATE_FILE', '/tmp/openalex-last-update')
+os.environ.setdefault('OA_PG_PW', '')
+
+from processors.postgres.staging import staging_table, create_staging_table, merge_statements  # noqa: E402
+from processors.postgres.tables import TableSpec  # noqa: E402
+from shared.config import settings  # noqa: E402
+
+SCHEMA = settings.pg_schema
+
+
+class StagingTest(unittest.TestCase):
+    concepts = TableSpec('concepts', ['display_name', 'level'])
+    ancestors = TableSpec('concepts_ancestors', ['concept_b_id'], key='concept_a_id', items='ancestors')
+
+    def test_create(self):
+        self.assertEqual(staging_table(self.ancestors), 'staging_concepts_ancestors')
+        self.assertEqual(create_staging_table(self.concepts),
+                         f'CREATE TEMPORARY TABLE staging_concepts ON COMMIT DROP AS '
+                         f'SELECT id,display_name,level FROM {SCHEMA}.concepts WITH NO DATA;')
+
+    def test_merge(self):
+        # The object table decides which objects are merged, no matter where it is in the list
+        self.assertEqual(merge_statements([self.ancestors, self.concepts]), [
+            'ANALYZE staging_concepts;',
+            f'INSERT INTO {SCHEMA}.concepts (id,display_name,level) SELECT id,display_name,level '
+            f'FROM staging_concepts ON CONFLICT (id) DO UPDATE SET display_name = EXCLUDED.display_name, '
+            f'level = EXCLUDED.level;',
+            f'DELETE FROM {SCHEMA}.concepts_ancestors t USING staging_concepts s WHERE t.concept_a_id = s.id;',
+            f'INSERT INTO {SCHEMA}.concepts_ancestors (concept_a_id,concept_b_id) SELECT concept_a_id,concept_b_id '
+            f'FROM staging_concepts_ancestors;',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
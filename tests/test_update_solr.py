@@ -0,0 +1,75 @@
+import os
+import time
+import threading
+import unittest
+from contextlib import closing
+
+# Settings are read on import, the transformers in these tests don't need any of them
+os.environ.setdefault('OA_SNAPSHOT', '/tmp/openalex-snapshot')
+os.environ.setdefault('OA_LAST_UPDATE_FILE', '/tmp/openalex-last-update')
+os.environ.setdefault('OA_PG_PW', '')
+
+import update_solr  # noqa: E402
+
+ORIGINAL_TRANSFORM = update_solr.transform_partition_kw
+
+
+def transform_ok(kwargs):
+    time.sleep(0.01)
+    return kwargs, 1, 0
+
+
+def transform_fail(kwargs):
+    if kwargs['in_file'] == 3:
+        raise ValueError('broken partition')
+    return transform_ok(kwargs)
+
+
+class TransformedTest(unittest.TestCase):
+    params = [{'in_file': pi} for pi in range(50)]  # many more than the pool may run ahead
+
+    def run_with_timeout(self, func, timeout: float = 30) -> BaseException | None:
+        # Runs `func` in a thread and fails if it did not return in time (i.e. the pool hangs)
+        errors = []
+
+        def target():
+            try:
+                func()
+            except BaseException as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), 'transformed() did not shut down')
+        return errors[0] if len(errors) > 0 else None
+
+    def test_all_partitions(self):
+        update_solr.transform_partition_kw = transform_ok
+        results = []
+        self.assertIsNone(self.run_with_timeout(
+            lambda: results.extend(update_solr.transformed(self.params, parallelism=2))))
+        self.assertEqual(sorted(kwargs['in_file'] for kwargs, _, _ in results), list(range(50)))
+
+    def test_worker_raises(self):
+        update_solr.transform_partition_kw = transform_fail
+        error = self.run_with_timeout(lambda: list(update_solr.transformed(self.params, parallelism=2)))
+        self.assertIsInstance(error, ValueError)
+
+    def test_consumer_raises(self):
+        update_solr.transform_partition_kw = transform_ok
+
+        def consume():
+            with closing(update_solr.transformed(self.params, parallelism=2)) as partitions:
+                for _ in partitions:
+                    raise RuntimeError('posting failed')
+
+        error = self.run_with_timeout(consume)
+        self.assertIsInstance(error, RuntimeError)
+
+    def tearDown(self):
+        update_solr.transform_partition_kw = ORIGINAL_TRANSFORM
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,6 +14,9 @@ override="--no-override"
 preserve_ram="--preserve-ram"
 jobs=1
 del_prior="--no-skip-deletion"
+pg_stream=false
+pg_format="csv"
+pg_merge="--no-merge"
 
 # Function to display script usage
 usage() {
@@ -30,6 +33,9 @@ usage() {
  echo " --override      Ignore existing flattened files and override them"
  echo " --jobs N        Number of processes for parallel processing"
  echo " --use-ram       Will not try to preserve RAM for small performance boost"
+ echo " --pg-stream     Stream flattened rows directly into postgres instead of writing files to TMP_DIR"
+ echo " --pg-binary     Use the binary COPY format instead of csv for postgres"
+ echo " --pg-merge      Merge updated rows into postgres via staging tables instead of deleting them first"
  echo ""
  echo " -h, --help      Display this help message"
 }
@@ -86,6 +92,15 @@ while [ $# -gt 0 ]; do
     --use-ram)
       preserve_ram="--no-preserve-ram"
       ;;
+    --pg-stream)
+      pg_stream=true
+      ;;
+    --pg-binary)
+      pg_format="binary"
+      ;;
+    --pg-merge)
+      pg_merge="--merge"
+      ;;
     *)
       echo "Invalid option: $1" >&2
       usage
@@ -134,7 +149,7 @@ fi
 
 if [ "$update_solr" = true ]; then
   echo "Updating solr..."
-  python update_solr.py "$del_prior" --loglevel INFO "$tmp_dir/solr"
+  python update_solr.py "$del_prior" --loglevel INFO --parallelism "$jobs" "$tmp_dir/solr"
   echo "Clearing $tmp_dir/solr"
   rm -r "$tmp_dir/solr"
 else
@@ -144,33 +159,34 @@ fi
 if [ "$update_pg" = true ]; then
   echo "Updating PostgreSQL..."
 
-  if [ "$pg_flatten" = true ]; then
-    python update_postgres.py --loglevel INFO --parallelism "$jobs" "$preserve_ram" "$del_prior" "$override" "$tmp_dir/postgres"
-  fi
-
   # shellcheck disable=SC2034
   export PGPASSWORD="$OA_PG_PW"  # set for passwordless postgres
 
-  echo "Dropping indexes to speed up imports..."
-  psql -f ./setup/pg_indices_drop.sql -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB"
+  if [ "$pg_stream" = true ]; then
+    echo "Dropping indexes to speed up imports..."
+    psql -f ./setup/pg_indices_drop.sql -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB"
 
-  # Go to directory where all the data is
-  cd "$tmp_dir" || exit
+    echo "Streaming new or updated objects into postgres"
+    python update_postgres.py --loglevel INFO --parallelism "$jobs" "$preserve_ram" "$del_prior" --stream --copy-format "$pg_format" "$pg_merge" "$tmp_dir/postgres"
 
-  if [ "$del_prior" = "--no-skip-deletion" ]; then
-    echo "Deleting merged objects"
-    find ./postgres -name "*-merged_del.sql" -exec psql -f {} -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB" \;
-    echo "Deleting existing new objects"
-    find ./postgres -name "*-del.sql" -exec psql -f {} -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB" \;
-  fi
-  echo "Import new or updated objects"
-  find ./postgres -name "*-cpy.sql" -exec psql -f {} -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB" \;
+    echo "Creating indexes again..."
+    python load_postgres.py --loglevel INFO --connections "$jobs" --streamed "$tmp_dir/postgres"
+  else
+    if [ "$pg_flatten" = true ]; then
+      python update_postgres.py --loglevel INFO --parallelism "$jobs" "$preserve_ram" "$del_prior" "$override" --copy-format "$pg_format" "$pg_merge" "$tmp_dir/postgres"
+    fi
 
-  # Go back to the script directory
-  cd "$SCRIPT_DIR" || exit
+    echo "Dropping indexes to speed up imports..."
+    psql -f ./setup/pg_indices_drop.sql -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB"
 
-  echo "Creating indexes again..."
-  psql -f ./setup/pg_indices.sql -p "$OA_PG_PORT" -h "$OA_PG_HOST" -U "$OA_PG_USER" --echo-all -d "$OA_PG_DB"
+    echo "Deleting existing and importing new or updated objects, then creating indexes again..."
+    # Failed scripts are listed at the end, indexes are created anyway.
+    # The flattened files and scripts are kept, so failed scripts can be loaded again.
+    if ! python load_postgres.py --loglevel INFO --connections "$jobs" "$del_prior" "$tmp_dir/postgres"; then
+      echo "Some scripts failed to load! Keeping $tmp_dir/postgres"
+      exit 1
+    fi
+  fi
 
   if [ "$cleanup" = true ]; then
     echo "Deleting all temporary flattened files and scripts"
@@ -3,8 +3,9 @@ from pathlib import Path
 
 import typer
 
-from processors.postgres.flatten import flatten_authors, flatten_concepts, flatten_funders, flatten_institutions, \
-    flatten_publishers, flatten_sources, flatten_works
+from processors.postgres.flatten import run, authors_jobs, concepts_jobs, funders_jobs, institutions_jobs, \
+    publishers_jobs, sources_jobs, works_jobs
+from processors.postgres.pgcopy import CopyFormat
 from shared.config import settings
 
 
@@ -13,6 +14,10 @@ def update_postgres(tmp_dir: Path,  # Directory where we can write temporary par
                     parallelism: int = 8,
                     override: bool = False,
                     preserve_ram: bool = True,
+                    stream: bool = False,  # Send rows straight to Postgres (COPY FROM STDIN) instead of writing files
+                    copy_format: CopyFormat = CopyFormat.csv,  # Format for COPY (binary is cheaper to ingest)
+                    works_shard_size: int = 512,  # Split works partitions larger than this (MB) across processes
+                    merge: bool = False,  # Merge rows into existing ones via staging tables instead of delete + copy
                     loglevel: str = 'INFO'):
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s (%(process)d): %(message)s', level=loglevel)
 
@@ -23,28 +28,22 @@ def update_postgres(tmp_dir: Path,  # Directory where we can write temporary par
 
     (tmp_dir / 'postgres').mkdir(parents=True, exist_ok=True)
 
-    logging.info('Flattening works')
-    flatten_works(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                  override=override, preserve_ram=preserve_ram)
-    logging.info('Flattening authors')
-    flatten_authors(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                    override=override, preserve_ram=preserve_ram)
-    logging.info('Flattening publishers')
-    flatten_publishers(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                       override=override, preserve_ram=preserve_ram)
-    logging.info('Flattening sources')
-    flatten_sources(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                    override=override, preserve_ram=preserve_ram)
-    logging.info('Flattening institutions')
-    flatten_institutions(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                         override=override, preserve_ram=preserve_ram)
-    logging.info('Flattening concepts')
-    flatten_concepts(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                     override=override, preserve_ram=preserve_ram)
-    logging.info('Flattening funders')
-    flatten_funders(tmp_dir=tmp_dir, parallelism=parallelism, skip_deletion=skip_deletion,
-                    override=override, preserve_ram=preserve_ram)
-    logging.info('Postgres files are flattened.')
+    # Partitions of all object types go into one pool (largest first), so no process idles between types
+    kwargs = dict(tmp_dir=tmp_dir, skip_deletion=skip_deletion, preserve_ram=preserve_ram, stream=stream,
+                  fmt=copy_format, merge=merge)
+    jobs = (works_jobs(**kwargs, parallelism=parallelism, shard_size=works_shard_size)
+            + authors_jobs(**kwargs)
+            + publishers_jobs(**kwargs)
+            + sources_jobs(**kwargs)
+            + institutions_jobs(**kwargs)
+            + concepts_jobs(**kwargs)
+            + funders_jobs(**kwargs))
+    logging.info(f'Flattening {len(jobs):,} partitions')
+    run(jobs, parallelism=parallelism, override=override)
+    if stream:
+        logging.info('Postgres is updated.')
+    else:
+        logging.info('Postgres files are flattened.')
     logging.warning(f'Remember to update the date in "{settings.last_update_file}"')
 
 
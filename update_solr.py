@@ -1,12 +1,21 @@
 import logging
-import subprocess
+import itertools
+import threading
+import multiprocessing
+from contextlib import closing
 from pathlib import Path
+from typing import Generator, Optional
 
 import typer
 
 from shared.config import settings
-from shared.util import get_globs, get_ids_to_delete, batched
-from processors.solr.transform_partition import transform_partition
+from shared.util import get_globs, get_ids_to_delete, picklify
+from processors.solr.transform_partition import transform_partition_kw
+from processors.solr.indexer import CommitStrategy, DocumentFormat
+from processors.solr.cloud import get_indexer, Periods, ensure_periods
+from processors.solr.admin import split_url, count_segments, optimize
+from processors.solr.fingerprints import FingerprintStore
+from processors.solr.manifest import Manifest, PartitionState
 
 
 def name_part(partition: Path):
@@ -14,8 +23,56 @@ def name_part(partition: Path):
     return f'{update}-{partition.stem}'
 
 
+def transformed(params: list[dict], parallelism: int) -> Generator[tuple[dict, int, int], None, None]:
+    # Yields partitions as soon as they are transformed (not necessarily in order).
+    if parallelism == 1:
+        for kwargs in params:
+            yield transform_partition_kw(kwargs)
+    else:
+        # The pool consumes `params` in a background thread, so we use the semaphore to keep it from
+        # running too far ahead of the poster and piling up transformed files in `tmp_dir`.
+        # When we stop early (a partition failed, posting failed or we are closed), that thread must not keep
+        # waiting for the semaphore, otherwise terminating the pool waits for it forever.
+        pending = threading.Semaphore(2 * parallelism)
+        stop = threading.Event()
+
+        def throttled():
+            for kwargs in picklify(params):
+                while not pending.acquire(timeout=1):
+                    if stop.is_set():
+                        return
+                yield kwargs
+
+        with multiprocessing.Pool(parallelism) as pool:
+            try:
+                for kwargs, n_works, n_abstracts in pool.imap_unordered(transform_partition_kw, throttled()):
+                    yield kwargs, n_works, n_abstracts
+                    pending.release()
+            finally:
+                stop.set()
+
+
 def update_solr(tmp_dir: Path,  # Directory where we can write temporary parsed partition files
                 skip_deletion: bool = False,
+                parallelism: int = 1,  # Number of processes transforming partitions while others are posted
+                raw_nested: bool = False,  # Pass through authorships and biblio from the snapshot without decoding
+                solr_copyfield: bool = False,  # Let Solr fill title_abstract via copyField (setup/solr_copyfield.json)
+                max_authorships: Optional[int] = None,  # Only keep the first N authorships (full list is in postgres)
+                fingerprints: Optional[Path] = None,  # Keep fingerprints of indexed works here and skip unchanged works
+                solr_connections: int = 4,  # Number of concurrent connections posting batches to Solr
+                solr_batch_size: int = 5000,  # Number of documents per update request
+                solr_format: DocumentFormat = DocumentFormat.json,  # Format of documents posted to Solr
+                route_to_leaders: bool = False,  # (SolrCloud) Post documents directly to their shard leaders
+                periods: Optional[str] = None,  # (SolrCloud) Comma-separated years to split works into collections
+                period_shards: int = 1,  # Number of shards when creating a new per-period collection
+                keep_moved: bool = False,  # Don't remove works from other periods (only for imports into empty ones)
+                commit_strategy: CommitStrategy = CommitStrategy.end,  # When to commit updates in Solr
+                commit_within: int = 60000,  # Used by "within" strategy (in ms)
+                soft_commit_interval: float = 60,  # Used by "soft" strategy (in s)
+                deletion_batch_size: int = 100000,  # Number of merged ids per delete request
+                merge_threshold: Optional[int] = None,  # Force a merge if a collection has more segments than this
+                merge_max_segments: int = 16,  # Number of segments to merge down to
+                fresh: bool = False,  # Ignore progress of a previous (failed) run and start from scratch
                 loglevel: str = 'INFO'):
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(name)s (%(process)d): %(message)s', level=loglevel)
 
@@ -29,44 +86,131 @@ def update_solr(tmp_dir: Path,  # Directory where we can write temporary parsed
     logging.info(f'Looks like there are {len(works)} works partitions '
                  f'and {len(merged)} merged_ids partitions since last update.')
 
-    for pi, partition in enumerate(works):
-        out_file = tmp_dir / f'solr-{name_part(partition)}.jsonl'
-        out_file.parent.mkdir(exist_ok=True, parents=True)
-
-        logging.debug(f'Reading partition from "{partition}" and writing to "{out_file}"')
-        n_works, n_abstracts = transform_partition(partition, out_file)
-        logging.info(f'({pi:,}/{len(works):,}) Partition contained {n_works:,} works '
-                     f'with {n_abstracts:,} abstracts (referring to {partition})')
-
-        subprocess.run([settings.solr_bin / 'post',
-                        '-c', settings.solr_collection,
-                        '-commit', 'yes',
-                        '-host', settings.solr_host,
-                        '-port', str(settings.solr_port),
-                        # '-type', 'text/csv',
-                        # '-filetype', 'csv',
-                        out_file])
-
-        logging.info('Partition posted to solr!')
-
-        # Cleaning up
-        out_file.unlink()
-
-    if not skip_deletion and len(merged) > 0:
-        logging.info('Going to delete merged works objects in batches...')
-        for del_batch in batched(get_ids_to_delete(merged), 1000):
-            ids = '</id><id>'.join(del_batch)
-            payload = f'<delete><id>{ids}</id></delete>'
-
-            subprocess.run([settings.solr_bin / 'post',
-                            '-c', settings.solr_collection,
-                            '-commit', 'yes',
-                            '-host', settings.solr_host,
-                            '-port', str(settings.solr_port),
-                            '-d', payload])
-    else:
-        logging.info('Found no merged work objects since last update and/or was asked to skip deletions!')
-
+    tmp_dir.mkdir(exist_ok=True, parents=True)
+    params = [
+        {
+            'in_file': partition,
+            'out_file': tmp_dir / f'solr-{name_part(partition)}.{solr_format.value}',
+            'fmt': solr_format,
+            'raw_nested': raw_nested,
+            'title_abstract': not solr_copyfield,
+            'max_authorships': max_authorships,
+            'period_routing': periods is not None,
+            'fingerprints': fingerprints,
+            'out_fingerprints': tmp_dir / f'solr-{name_part(partition)}.fp' if fingerprints is not None else None,
+            'out_partial': tmp_dir / f'solr-{name_part(partition)}.partial.jsonl' if fingerprints is not None else None
+        }
+        for partition in works
+    ]
+
+    manifest_file = tmp_dir / 'solr-manifest.json'
+    if fresh:
+        manifest_file.unlink(missing_ok=True)
+    manifest = Manifest(manifest_file)
+
+    # Skip partitions a previous run already finished and post those still lying around transformed
+    todo = []
+    ready = []
+    n_posted = 0
+    for kwargs in params:
+        entry = manifest.get(name_part(kwargs['in_file']), kwargs['in_file'])
+        outputs = [kwargs[key] for key in ['out_file', 'out_fingerprints', 'out_partial'] if kwargs[key] is not None]
+        if entry is None:
+            todo.append(kwargs)
+        elif entry['state'] in {PartitionState.posted, PartitionState.committed}:
+            n_posted += 1  # posted ones are committed with everything else at the end
+        elif entry['state'] == PartitionState.transformed and all(out.exists() for out in outputs):
+            ready.append((kwargs, entry['n_works'], entry['n_abstracts']))
+        else:
+            todo.append(kwargs)
+    if n_posted > 0 or len(ready) > 0:
+        logging.info(f'Skipping {n_posted:,} partitions that were posted in a previous run, '
+                     f'{len(ready):,} partitions are already transformed.')
+
+    store = None
+    if fingerprints is not None:
+        # Make sure the store exists before transformers open it read-only
+        store = FingerprintStore(fingerprints)
+        logging.info(f'Using fingerprints in "{fingerprints}" to skip unchanged works '
+                     f'and update counters in-place where possible.')
+
+    period_collections = None
+    if periods is not None:
+        # The collection name becomes an alias for all per-period collections
+        period_collections = Periods(split_url(settings.solr_url)[1], [int(year) for year in periods.split(',')])
+        ensure_periods(settings.solr_url, period_collections, settings.solr_configset, num_shards=period_shards)
+        logging.info(f'Posting works to per-period collections {", ".join(period_collections.names)}')
+
+    # If posting fails, the transforming pool is shut down right away (not whenever the generator is collected)
+    with get_indexer(settings.solr_url, route_to_leaders=route_to_leaders,
+                     periods=period_collections, remove_moved=not keep_moved,
+                     batch_size=solr_batch_size, n_connections=solr_connections,
+                     commit_strategy=commit_strategy, commit_within=commit_within,
+                     soft_commit_interval=soft_commit_interval) as indexer, \
+            closing(transformed(todo, parallelism=parallelism)) as partitions:
+        indexer.log_strategy()
+        n_partitions = len(ready) + len(todo)
+        for pi, (kwargs, n_works, n_abstracts) in enumerate(itertools.chain(ready, partitions)):
+            partition, out_file = Path(kwargs['in_file']), Path(kwargs['out_file'])
+            name = name_part(partition)
+            manifest.mark(name, partition, PartitionState.transformed, n_works=n_works, n_abstracts=n_abstracts)
+            logging.info(f'({pi + 1:,}/{n_partitions:,}) Partition contained {n_works:,} works '
+                         f'with {n_abstracts:,} abstracts (referring to {partition})')
+
+            indexer.post_file(out_file, fmt=solr_format)
+            if kwargs['out_partial'] is not None:
+                n_partial = indexer.post_file(kwargs['out_partial'], atomic=True)
+                logging.info(f'Posting {n_partial:,} in-place counter updates.')
+            indexer.partition_done()
+            indexer.flush()  # the last batch of this partition might still be pending otherwise
+            manifest.mark(name, partition, (PartitionState.committed
+                                            if commit_strategy == CommitStrategy.partition
+                                            else PartitionState.posted))
+
+            logging.info('Partition posted to solr!')
+
+            # Cleaning up
+            out_file.unlink()
+            if kwargs['out_partial'] is not None:
+                Path(kwargs['out_partial']).unlink()
+
+        merged_ids = []
+        if not skip_deletion and len(merged) > 0:
+            logging.info('Going to delete merged works objects...')
+            merged_ids = list(get_ids_to_delete(merged))
+            n_deleted = indexer.delete_ids(merged_ids, batch_size=deletion_batch_size)
+            logging.info(f'Deleted {n_deleted:,} merged works objects.')
+        else:
+            logging.info('Found no merged work objects since last update and/or was asked to skip deletions!')
+
+        indexer.commit()
+        manifest.mark_all(PartitionState.posted, PartitionState.committed)
+
+        if store is not None:
+            # Only remember what we sent once it is committed in Solr
+            for kwargs in params:
+                if kwargs['out_fingerprints'].exists():
+                    store.update_from_file(kwargs['out_fingerprints'])
+                    kwargs['out_fingerprints'].unlink()
+            store.delete(merged_ids)
+            store.close()
+
+        logging.info(f'Posted {indexer.n_docs:,} documents in {indexer.n_batches:,} batches to Solr '
+                     f'with {indexer.n_commits:,} commits taking {indexer.commit_time:.2f}s in total.')
+
+    if merge_threshold is not None:
+        base_url, _ = split_url(settings.solr_url)
+        for url in ([settings.solr_url] if period_collections is None
+                    else [f'{base_url}/{name}' for name in period_collections.names]):
+            n_segments = count_segments(url)
+            if n_segments > merge_threshold:
+                logging.info(f'Found {n_segments:,} segments in {url}, merging down to {merge_max_segments:,}...')
+                duration = optimize(url, max_segments=merge_max_segments)
+                logging.info(f'Merge took {duration:.2f}s, now there are {count_segments(url):,} segments in {url}')
+            else:
+                logging.info(f'Found {n_segments:,} segments in {url}, no need to merge.')
+
+    manifest.remove()
     logging.info('Solr collection is up to date.')
     logging.warning(f'Remember to update the date in "{settings.last_update_file}"')
 